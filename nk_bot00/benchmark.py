@@ -0,0 +1,304 @@
+import os
+import gzip
+import json
+import random
+import platform
+import sqlite3
+from pathlib import Path
+from sys import argv
+from tempfile import TemporaryDirectory
+from time import perf_counter, perf_counter_ns
+from typing import Callable, Optional
+
+from mirai.models.events import FriendMessage, GroupMessage
+
+from nk_bot00.mapping import (Mapping, OPTIONS_TYPE, OPTIONS_NAMESPACE,
+                              build_database)
+from nk_bot00.router import CommandRouter
+
+VERSION = '1.19.2'
+YARN_VERSION = '1.19.2+build.1'
+CLASSES = 7000
+'''与 1.19.2 的映射规模相近'''
+FIELDS_PER_CLASS = 5
+METHODS_PER_CLASS = 9
+SAMPLES = 500
+'''每种查找的次数'''
+SEED = 0
+
+WORDS = (
+    'block', 'pos', 'entity', 'world', 'item', 'stack', 'render', 'state',
+    'client', 'server', 'network', 'packet', 'chunk', 'biome', 'sound',
+    'screen', 'player', 'tick', 'data', 'model', 'texture', 'recipe',
+)
+PACKAGES = ('block', 'entity', 'world', 'item', 'client.render', 'network')
+PRIMITIVES = (('I', 'int'), ('Z', 'boolean'), ('F', 'float'),
+              ('D', 'double'), ('J', 'long'))
+
+
+def obfuscate(index: int) -> str:
+    '''a, b, ..., z, aa, ab, ...'''
+    name = ''
+    index += 1
+    while index > 0:
+        index, rest = divmod(index - 1, 26)
+        name = chr(ord('a') + rest) + name
+    return name
+
+
+def camel(rng: random.Random, count: int, upper: bool) -> str:
+    words = [rng.choice(WORDS) for _ in range(count)]
+    name = ''.join(w.capitalize() for w in words)
+    return name if upper else name[0].lower() + name[1:]
+
+
+def generate_mapping(
+    scale: int,
+    mojang_path: Path,
+    yarn_path: Path,
+    seed: int = SEED
+) -> dict[str, int]:
+    '''生成互相对应的 proguard 与 tiny v1 映射文件，返回各类型的数量'''
+    rng = random.Random(seed)
+    count = CLASSES * scale
+    classes = []
+    for i in range(count):
+        package = rng.choice(PACKAGES)
+        classes.append((
+            obfuscate(i),
+            f'net.minecraft.{package}.{camel(rng, 2, True)}{i}',
+            f'net/minecraft/{package.replace(".", "/")}/'
+            f'{camel(rng, 2, True)}{i}',
+        ))
+
+    def random_type() -> tuple[str, str]:
+        '''返回 (official 描述符, mojang 类型)'''
+        if rng.random() < 0.5:
+            return rng.choice(PRIMITIVES)
+        official, mojang, _ = rng.choice(classes)
+        return f'L{official};', mojang
+
+    fields = methods = 0
+    with open(mojang_path, 'w', encoding='utf-8') as mojang, \
+            gzip.open(yarn_path, 'wt', encoding='utf-8') as yarn:
+        mojang.write('# synthetic mapping\n')
+        yarn.write('v1\tofficial\tintermediary\tnamed\n')
+        for i, (official, mojang_name, yarn_name) in enumerate(classes):
+            mojang.write(f'{mojang_name} -> {official}:\n')
+            yarn.write(f'CLASS\t{official}\tnet/minecraft/class_{i}\t'
+                       f'{yarn_name}\n')
+            members = 0
+            for _ in range(rng.randint(0, 2 * FIELDS_PER_CLASS)):
+                descriptor, type_ = random_type()
+                name = obfuscate(members)
+                members += 1
+                mojang.write(f'    {type_} {camel(rng, 2, False)} -> {name}\n')
+                yarn.write(f'FIELD\t{official}\t{descriptor}\t{name}\t'
+                           f'field_{fields}\t{camel(rng, 2, False)}\n')
+                fields += 1
+            for _ in range(rng.randint(0, 2 * METHODS_PER_CLASS)):
+                arguments = [random_type() for _ in range(rng.randint(0, 3))]
+                result = ('V', 'void') if rng.random() < 0.3 else random_type()
+                name = obfuscate(members)
+                members += 1
+                mojang.write(
+                    f'    1:5:{result[1]} {camel(rng, 2, False)}'
+                    f'({",".join(a[1] for a in arguments)}) -> {name}\n')
+                yarn.write(
+                    f'METHOD\t{official}\t'
+                    f'({"".join(a[0] for a in arguments)}){result[0]}\t'
+                    f'{name}\tmethod_{methods}\t{camel(rng, 2, False)}\n')
+                methods += 1
+    return {'class': count, 'field': fields, 'method': methods}
+
+
+def percentile(samples: list[int], p: float) -> float:
+    '''返回第 p 百分位数，单位为微秒'''
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))] / 1000
+
+
+def measure(find: Callable[[str], object], names: list[str]) -> dict[str, float]:
+    samples = []
+    for name in names:
+        start = perf_counter_ns()
+        find(name)
+        samples.append(perf_counter_ns() - start)
+    return {
+        'count': len(samples),
+        'p50_us': percentile(samples, 0.5),
+        'p99_us': percentile(samples, 0.99),
+    }
+
+
+def lookup_cases(
+    path: Path,
+    rng: random.Random
+) -> dict[str, tuple[Optional[str], Optional[str], list[str]]]:
+    '''{Case: (Type, Namespace, [Name, ...]), ...}'''
+    cases = {}
+    c = sqlite3.connect(path)
+    for t in OPTIONS_TYPE:
+        for ns in OPTIONS_NAMESPACE:
+            names = [row[0] for row in c.execute(
+                f'SELECT {ns} FROM {t} WHERE {ns} IS NOT NULL;')]
+            cases[f'hit {t} {ns}'] = (
+                t, ns, [rng.choice(names) for _ in range(SAMPLES)])
+    # 不指定类型与命名空间时依次尝试所有组合
+    cases['hit any'] = (None, None, [
+        rng.choice(cases[f'hit {rng.choice(OPTIONS_TYPE)} '
+                         f'{rng.choice(OPTIONS_NAMESPACE)}'][2])
+        for _ in range(SAMPLES)
+    ])
+    shorts = [row[0] for row in c.execute(
+        'SELECT yarn_short FROM class WHERE yarn_short IS NOT NULL;')]
+    c.close()
+    cases['short class'] = (
+        None, None, [rng.choice(shorts) for _ in range(SAMPLES)])
+    cases['miss'] = (
+        None, None, [f'missing{i}' for i in range(SAMPLES)])
+    return cases
+
+
+def benchmark_scale(scale: int, directory: Path) -> dict:
+    print(f'Generating mapping at scale {scale}...', flush=True)
+    mojang_path = directory / f'client-{scale}.txt'
+    yarn_path = directory / f'yarn-{scale}-tiny.gz'
+    counts = generate_mapping(scale, mojang_path, yarn_path)
+    # build_database 写入工作目录下的 mapping 目录
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        (directory / 'mapping').mkdir(exist_ok=True)
+        timings = build_database(
+            VERSION, YARN_VERSION, mojang_path, yarn_path)
+    finally:
+        os.chdir(cwd)
+    path = directory / 'mapping' / f'{YARN_VERSION}.db'
+    mapping = Mapping(path)
+    mapping.warm_up()
+    rng = random.Random(SEED)
+    c = mapping.connect()
+    backends: dict[str, Callable] = {
+        'sqlite': lambda name, t, ns: mapping.find_with(c, name, t, ns)}
+    if mapping.compact is not None:
+        backends['compact'] = mapping.compact.find
+    lookup: dict[str, dict[str, dict[str, float]]] = {}
+    print(f'Measuring lookup at scale {scale}...', flush=True)
+    for case, (t, ns, names) in lookup_cases(path, rng).items():
+        for backend, find in backends.items():
+            lookup.setdefault(backend, {})[case] = measure(
+                lambda name, find=find: find(name, t, ns), names)
+    c.close()
+    mapping.close()
+    return {
+        'scale': scale,
+        'count': counts,
+        'size': {
+            'mojang': os.path.getsize(mojang_path),
+            'yarn': os.path.getsize(yarn_path),
+            'database': os.path.getsize(path),
+            'compact': (os.path.getsize(path.with_suffix('.bin'))
+                        if path.with_suffix('.bin').exists() else None),
+        },
+        'import': timings,
+        'lookup': lookup,
+    }
+
+
+def benchmark_mapping() -> None:
+    args = argv[1:]
+    output = Path('benchmark.json')
+    scales = []
+    try:
+        while len(args) > 0:
+            arg = args.pop(0)
+            if arg == '--output':
+                output = Path(args.pop(0))
+            else:
+                scales.append(int(arg))
+    except (IndexError, ValueError):
+        print('Usage: benchmark [--output <file>] [<scale>...]')
+        return
+    if len(scales) == 0:
+        scales = [1, 10]
+    result = {
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'runs': [],
+    }
+    for scale in scales:
+        with TemporaryDirectory() as directory:
+            result['runs'].append(benchmark_scale(scale, Path(directory)))
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, indent=4)
+    for run in result['runs']:
+        print(f'Scale {run["scale"]}: {run["count"]}')
+        for phase, second in run['import'].items():
+            print(f'    {phase}: {second:.3f} s')
+        for backend, cases in run['lookup'].items():
+            for case, stat in cases.items():
+                print(f'    {backend} {case}: p50 {stat["p50_us"]:.1f} us, '
+                      f'p99 {stat["p99_us"]:.1f} us')
+    print(f'Results written to {output}')
+
+
+ROUTER_MESSAGES = {
+    'chat': [{'type': 'Plain', 'text': '今天也要好好吃饭' * 8}],
+    'image': [{'type': 'Plain', 'text': '看'},
+              {'type': 'Image', 'imageId': '{0}.png'}],
+    'command': [{'type': 'Plain', 'text': '!m BlockPos method yarn'}],
+    'quoted command': [{'type': 'Plain', 'text': '!echo "a b" \'c d\''}],
+    'unavailable command': [{'type': 'Plain', 'text': '!hello'}],
+}
+'''{Kind: MessageChain, ...}'''
+ROUTER_ROUNDS = 100000
+
+
+def router_event(chain: list[dict], group: Optional[int]) -> object:
+    chain = [{'type': 'Source', 'id': 1, 'time': 0}] + chain
+    if group is None:
+        return FriendMessage.parse_obj({
+            'type': 'FriendMessage',
+            'sender': {'id': 1, 'nickname': '', 'remark': ''},
+            'messageChain': chain,
+        })
+    return GroupMessage.parse_obj({
+        'type': 'GroupMessage',
+        'sender': {
+            'id': 1, 'memberName': '', 'permission': 'MEMBER',
+            'group': {'id': group, 'name': '', 'permission': 'MEMBER'},
+        },
+        'messageChain': chain,
+    })
+
+
+def benchmark_router() -> None:
+    '''测量命令路由每秒处理的消息数'''
+    # 避免导入 main 时连带导入所有命令
+    handlers: dict[str, Callable] = {
+        command: lambda *_: None for command in ('mapping', 'echo', 'hello')}
+    router = CommandRouter(
+        handlers, {'m': 'mapping', 'h': 'help'}, ('!', '！'),
+        {1: ['echo', 'mapping']},
+        {group: ['mapping', 'echo'] for group in range(100)}
+    )
+    events = {
+        kind: router_event(chain, 1) for kind, chain in ROUTER_MESSAGES.items()}
+    events['unknown group'] = router_event(ROUTER_MESSAGES['command'], 1000)
+    events['friend command'] = router_event(ROUTER_MESSAGES['command'], None)
+    result = {}
+    for kind, event in events.items():
+        start = perf_counter()
+        for _ in range(ROUTER_ROUNDS):
+            router.route(event)
+        result[kind] = ROUTER_ROUNDS / (perf_counter() - start)
+        print(f'{kind}: {result[kind]:.0f} messages/s ({router.route(event)})')
+    if len(argv) > 1:
+        with open(argv[1], 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=4)
+
+
+if __name__ == '__main__':
+    benchmark_mapping()
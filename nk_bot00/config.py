@@ -0,0 +1,119 @@
+import json
+from typing import Any, cast
+
+from nk_bot00.router import BUILTIN_COMMANDS, CommandHandler, CommandRouter
+from nk_bot00.mapping import validate_mapping_config
+from nk_bot00.scheduler import is_positive, validate_scheduler_config
+from nk_bot00.util import parse_logging_config
+
+CONFIG_PATH = 'config.json'
+REQUIRED_KEYS = ('command_prefix', 'friend_permission', 'group_permission',
+                 'bot_qq', 'verify_key', 'host', 'port', 'su_qq',
+                 'command_config', 'ctf')
+RESTART_KEYS = ('bot_qq', 'verify_key', 'host', 'port')
+'''修改后需要重新启动才能生效的配置'''
+CTF_KEYS = ('enabled', 'gosessid', 'wait_second', 'broadcast')
+CTF_BROADCAST_KEYS = ('target', 'week', 'all_kill_category', 'all_kill',
+                      'new_challenge', 'blood', 'score_lower_than')
+
+
+def is_id(value: Any) -> bool:
+    '''QQ 号或群号，可以是整数或数字字符串'''
+    if isinstance(value, int):
+        return not isinstance(value, bool)
+    if not isinstance(value, str):
+        return False
+    try:
+        int(value)
+    except ValueError:
+        return False
+    return True
+
+
+def validate_permission(permission: Any, commands: set[str], name: str) -> None:
+    if not isinstance(permission, dict):
+        raise ValueError(f'{name} is not an object')
+    for k, v in permission.items():
+        if not is_id(k):
+            raise ValueError(f'{name}: "{k}" is not an id')
+        if not isinstance(v, list) or any(not isinstance(c, str) for c in v):
+            raise ValueError(f'{name}: "{k}" is not a list of commands')
+        unknown = set(v) - commands - BUILTIN_COMMANDS
+        if len(unknown) > 0:
+            raise ValueError(
+                f'{name}: "{k}" has unknown commands {sorted(unknown)}')
+
+
+def validate_config(config: Any, commands: set[str]) -> None:
+    '''检查配置，有错误时抛出 ValueError'''
+    if not isinstance(config, dict):
+        raise ValueError('Config is not an object')
+    for key in REQUIRED_KEYS:
+        if key not in config:
+            raise ValueError(f'Missing {key}')
+    if not isinstance(config['su_qq'], int) or isinstance(config['su_qq'], bool):
+        raise ValueError('su_qq is not an integer')
+    prefix = config['command_prefix']
+    if (not isinstance(prefix, list) or len(prefix) == 0
+            or any(not isinstance(p, str) or len(p) != 1 for p in prefix)):
+        raise ValueError('command_prefix is not a list of characters')
+    validate_permission(
+        config['friend_permission'], commands, 'friend_permission')
+    validate_permission(
+        config['group_permission'], commands, 'group_permission')
+    if not isinstance(config['command_config'], dict) or any(
+            not isinstance(v, dict) for v in config['command_config'].values()):
+        raise ValueError('command_config is not an object of objects')
+    validate_scheduler_config(config.get('scheduler', {}))
+    validate_mapping_config(config['command_config'].get('mapping', {}))
+    if not isinstance(config.get('logging', {}), dict):
+        raise ValueError('logging is not an object')
+    parse_logging_config(config.get('logging', {}))
+    ctf = config['ctf']
+    if not isinstance(ctf, dict) or any(k not in ctf for k in CTF_KEYS):
+        raise ValueError(f'ctf requires {", ".join(CTF_KEYS)}')
+    if (not isinstance(ctf['broadcast'], dict)
+            or set(ctf['broadcast']) != set(CTF_BROADCAST_KEYS)):
+        raise ValueError(
+            f'ctf.broadcast requires {", ".join(CTF_BROADCAST_KEYS)}')
+    if not isinstance(ctf['enabled'], bool):
+        raise ValueError('ctf.enabled is not a boolean')
+    if not isinstance(ctf['gosessid'], str):
+        raise ValueError('ctf.gosessid is not a string')
+    if not is_positive(ctf['wait_second']):
+        raise ValueError('ctf.wait_second is not a positive number')
+    target = ctf['broadcast']['target']
+    if not isinstance(target, list) or any(not is_id(t) for t in target):
+        raise ValueError('ctf.broadcast.target is not a list of ids')
+
+
+def load_config(commands: set[str], path: str = CONFIG_PATH) -> dict[str, Any]:
+    with open(path, 'r', encoding='utf8') as f:
+        config = json.load(f)
+    validate_config(config, commands)
+    return config
+
+
+class BotConfig:
+    '''由 config.json 生成的配置，重新加载时整体替换'''
+
+    def __init__(
+        self,
+        config: dict[str, Any],
+        handlers: dict[str, CommandHandler],
+        alias: dict[str, str]
+    ) -> None:
+        self.raw = config
+        self.su: int = config['su_qq']
+        self.command_prefix = cast(
+            tuple[str], tuple(config['command_prefix']))
+        self.command_config: dict[str, dict] = {
+            c: config['command_config'].get(c, {}) for c in handlers}
+        self.command_config['help'] = {}
+        self.ctf: dict[str, Any] = config['ctf']
+        self.router = CommandRouter(
+            handlers, alias, self.command_prefix,
+            {int(k): v for k, v in config['friend_permission'].items()},
+            {int(k): v for k, v in config['group_permission'].items()},
+            self.su
+        )
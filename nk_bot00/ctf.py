@@ -1,11 +1,13 @@
 from typing import Any
 from collections import defaultdict
+from time import perf_counter
 
 from mirai import Mirai
 import httpx
 
 import nk_bot00
 import nk_bot00.util
+from nk_bot00.metrics import HTTP_CLIENT_DURATION
 
 URL_BASE = 'https://0xgame.h4ck.fun/api/v1'
 
@@ -15,18 +17,13 @@ class CTFGameStatus:
                  all_kill_category: bool, all_kill: bool, new_challenge: bool,
                  blood: bool, score_lower_than: int) -> None:
         self.bot = bot
-        self.target = list(map(int, target))
-        self.week = week
-        self.all_kill_category = all_kill_category
-        self.all_kill = all_kill
-        self.new_challenge = new_challenge
-        self.blood = blood
-        self.score_lower_than = score_lower_than
         self.client = httpx.AsyncClient(headers={
             'User-Agent': f'nk_bot00/{nk_bot00.__version__}'
             f' (https://github.com/NKID00/nk_bot00)'
             f' httpx/{httpx.__version__}'
-        }, cookies={'GOSESSID': gosessid})
+        })
+        self.configure(gosessid, target, week, all_kill_category, all_kill,
+                       new_challenge, blood, score_lower_than)
         self.challenges: dict[int, Any] = {}
         '''{ChallengeId: Any, ...}'''
         self.previous_challenges: dict[int, Any] = {}
@@ -41,8 +38,28 @@ class CTFGameStatus:
         '''{UserId: {ChallengeId, ...}, ...}'''
         self.logger = nk_bot00.util.get_logger('ctf')
 
+    def configure(self, gosessid: str, target: list[str], week: str,
+                  all_kill_category: bool, all_kill: bool, new_challenge: bool,
+                  blood: bool, score_lower_than: int) -> None:
+        '''更新播报设置，保留已查询到的题目与解题记录'''
+        self.client.cookies.set('GOSESSID', gosessid)
+        self.target = list(map(int, target))
+        self.week = week
+        self.all_kill_category = all_kill_category
+        self.all_kill = all_kill
+        self.new_challenge = new_challenge
+        self.blood = blood
+        self.score_lower_than = score_lower_than
+
     async def call_api(self, api: str) -> Any:
-        r = await self.client.get(URL_BASE + api)
+        start = perf_counter()
+        try:
+            r = await self.client.get(URL_BASE + api)
+        except httpx.TransportError:
+            HTTP_CLIENT_DURATION.observe(perf_counter() - start, (api, 'error'))
+            raise
+        HTTP_CLIENT_DURATION.observe(
+            perf_counter() - start, (api, str(r.status_code)))
         r.raise_for_status()
         data = r.json()
         if data['code'] != 200:
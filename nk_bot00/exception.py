@@ -1,2 +1,6 @@
 class ArgumentException(Exception):
     pass
+
+
+class BusyException(Exception):
+    pass
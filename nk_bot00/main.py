@@ -1,24 +1,30 @@
-import shlex
-import json
+import os
 import asyncio
 import traceback
-from typing import Any, Awaitable, Callable, Iterable, cast
+from typing import Optional
 
-from mirai import (Mirai, FriendMessage, GroupMessage, MessageEvent,
+from mirai import (Mirai, GroupMessage, MessageEvent, Startup,
                    WebSocketAdapter)
+from mirai.asgi import ASGI
 import httpx
 
+from nk_bot00.config import BotConfig, CONFIG_PATH, RESTART_KEYS, load_config
 from nk_bot00.exception import ArgumentException
 from nk_bot00.hello import on_command_hello
 from nk_bot00.echo import on_command_echo
-from nk_bot00.mapping import on_command_mapping
+from nk_bot00.mapping import (RESULTS, on_command_mapping, on_http_mapping,
+                              setup_mapping)
+from nk_bot00.metrics import (CTF_POLL_DURATION, CTF_POLL_TIMEOUTS, METRICS,
+                              monitor_loop_lag, on_http_metrics,
+                              timed_endpoint)
 from nk_bot00.ping import on_command_ping
 from nk_bot00.ctf import CTFGameStatus
-from nk_bot00.util import get_logger
+from nk_bot00.scheduler import CommandScheduler
+from nk_bot00.router import CommandHandler
+from nk_bot00.util import get_log_pipeline, get_logger
 
 
-COMMAND_HANDLER: dict[str, Callable[
-    [Mirai, MessageEvent, list[str], Any], Awaitable[None]]] = {
+COMMAND_HANDLER: dict[str, CommandHandler] = {
     'hello': on_command_hello,
     'echo': on_command_echo,
     'mapping': on_command_mapping,
@@ -28,147 +34,181 @@ COMMAND_ALIAS: dict[str, str] = {
     'h': 'help',
     'm': 'mapping'
 }
-
-
-def get_help_message(args: list[str], command_prefix: tuple[str],
-                     available_commands: Iterable[str]) -> str:
-    if len(args) == 1:
-        command = args[0].strip()
-        if command.startswith(command_prefix):
-            # 只接受允许的前缀开头的命令
-            command = command[1:].strip()
-        command = COMMAND_ALIAS.get(command, command)
-        if command == 'help':
-            return (
-                '!h [命令]\n'
-                '  显示命令用法'
-            )
-        if command in COMMAND_HANDLER:
-            docstring = COMMAND_HANDLER[command].__doc__
-            if docstring is not None:
-                return '\n  '.join(
-                    s.strip() for s in docstring.splitlines(False))
-        raise ArgumentException('未知命令')
-    if len(args) > 1:
-        raise ArgumentException('参数过多')
-    return (
-        '![命令] [参数...]\n'
-        '  执行命令\n'
-        '!h [命令]\n'
-        '  显示命令用法\n'
-        '  [命令] := ' + ' | '.join(available_commands)
-    )
+CONFIG_POLL_SECOND = 2.0
+'''检查 config.json 是否被修改的间隔'''
 
 
 def main() -> None:
     logger = get_logger()
-    with open('config.json', 'r', encoding='utf8') as f:
-        config = json.load(f)
-    command_prefix = cast(tuple[str], tuple(config['command_prefix']))
-    friend_permission = {
-        int(k): v for k, v in config['friend_permission'].items()}
-    group_permission = {
-        int(k): v for k, v in config['group_permission'].items()}
+    commands = set(COMMAND_HANDLER)
+    config = load_config(commands)
+    log_pipeline = get_log_pipeline()
+    log_pipeline.configure(config.get('logging', {}))
+    current = BotConfig(config, COMMAND_HANDLER, COMMAND_ALIAS)
     bot = Mirai(config['bot_qq'], adapter=WebSocketAdapter(
         verify_key=config['verify_key'],
         host=config['host'], port=config['port']
     ))
-    su = config['su_qq']
-    command_config = config['command_config']
-    command_config['help'] = {}
-    for c in COMMAND_HANDLER:
-        if c not in command_config:
-            command_config[c] = {}
+    scheduler = CommandScheduler(config.get('scheduler', {}))
+    METRICS.gauge(
+        'nk_bot00_commands_in_flight', 'Commands being handled', ('command',),
+        lambda: {(k,): v for k, v in scheduler.in_flight.items()})
+    METRICS.gauge(
+        'nk_bot00_mapping_cache_entries', 'Cached mapping results',
+        collect=lambda: {(): RESULTS.stats()['size']})
+    METRICS.counter(
+        'nk_bot00_mapping_cache_requests_total', 'Mapping result cache lookups',
+        ('result',), lambda: {
+            (k,): v for k, v in RESULTS.stats().items() if k != 'size'})
+    METRICS.counter(
+        'nk_bot00_log_records_dropped_total',
+        'Log records dropped because the log queue was full',
+        collect=lambda: {(): log_pipeline.dropped})
+    METRICS.gauge(
+        'nk_bot00_log_queue_depth', 'Log records waiting to be written',
+        collect=lambda: {(): log_pipeline.depth})
+    game_status: Optional[CTFGameStatus] = None
+    reload_lock: Optional[asyncio.Lock] = None
+
+    async def reload_config() -> str:
+        '''重新读取配置，检查无误后替换，只更新有变化的部分'''
+        nonlocal current, reload_lock
+        # bot.run() 会新建事件循环，Python 3.9 的锁绑定创建时的循环
+        if reload_lock is None:
+            reload_lock = asyncio.Lock()
+        async with reload_lock:
+            # 先读取并检查全部配置，有错误时不做任何修改
+            try:
+                config = load_config(commands)
+                new = BotConfig(config, COMMAND_HANDLER, COMMAND_ALIAS)
+            except (OSError, ValueError) as exc:
+                logger.error('Invalid config: %s', exc)
+                return f'配置无效：{exc}'
+            old = current
+            # 替换后新的消息使用新的配置，正在处理的消息不受影响
+            current = new
+            for key in RESTART_KEYS:
+                if config[key] != old.raw[key]:
+                    logger.warning('Changing %s requires restart', key)
+            # 以下只使用已检查过的配置
+            if config.get('logging') != old.raw.get('logging'):
+                log_pipeline.configure(config.get('logging', {}))
+            if config.get('scheduler') != old.raw.get('scheduler'):
+                scheduler.configure(config.get('scheduler', {}))
+            if config['ctf'] != old.raw['ctf'] and game_status is not None:
+                game_status.configure(
+                    config['ctf']['gosessid'], **config['ctf']['broadcast'])
+            if new.command_config['mapping'] != old.command_config['mapping']:
+                try:
+                    await setup_mapping(new.command_config['mapping'])
+                except Exception:  # pylint: disable=broad-except
+                    # 预热失败不影响已生效的配置
+                    logger.exception('Failed to set up mapping')
+            logger.info('Config reloaded')
+            return '配置已重新加载'
+
+    @bot.on(Startup)
+    async def _(_event: Startup):
+        await setup_mapping(current.command_config['mapping'])
+
+    # 与 bot 共用 localhost:32181 上的 ASGI 服务器
+    ASGI().add_route('/mapping', timed_endpoint('/mapping', on_http_mapping),
+                     methods=['POST'])
+    ASGI().add_route('/metrics', on_http_metrics, methods=['GET'])
 
     @bot.on(MessageEvent)
     async def _(event: MessageEvent):
-        nonlocal config, command_prefix, friend_permission, group_permission
-        nonlocal bot, su, command_config
+        nonlocal bot, scheduler
+        bot_config = current
         try:
-            if isinstance(event, FriendMessage):
-                if event.sender.id not in friend_permission:
-                    return
-                available_commands = friend_permission[event.sender.id]
-            elif isinstance(event, GroupMessage):
-                if event.group.id not in group_permission:
-                    return
-                available_commands = group_permission[event.group.id]
-            else:
+            routed = bot_config.router.route(event)
+            if routed is None:
                 return
+            command, args = routed
+            group = event.group.id if isinstance(event, GroupMessage) else None
 
-            if any(item.type not in ['Source', 'Plain']
-                   for item in event.message_chain):
-                # 只接受纯文本
-                return
-            message = str(event.message_chain).strip()
-            if not message.startswith(command_prefix):
-                # 只接受允许的前缀开头的命令
-                return
-            message = message[1:].strip()
-            splitted = shlex.split(message)
-            if len(splitted) == 0:
-                # 不接受空命令
-                return
-            command, *args = splitted
-            command = COMMAND_ALIAS.get(command, command)
-
-            try:
+            async def handler() -> None:
                 if command == 'help':
-                    await bot.send(event, get_help_message(
-                        args, command_prefix, available_commands))
-                elif command in available_commands:
-                    await COMMAND_HANDLER[command](bot, event, args,
-                                                   command_config[command])
-            except ArgumentException as exc:
-                docstring = COMMAND_HANDLER[command].__doc__
-                if docstring is not None:
                     await bot.send(
-                        event,
-                        f'{exc}\n'
-                        + '\n  '.join(
-                            s.strip() for s in docstring.splitlines(False))
-                    )
+                        event, bot_config.router.help_message(event, args))
+                elif command == 'reload':
+                    await bot.send(event, await reload_config())
                 else:
-                    await bot.send(
-                        event,
-                        f'{exc}\n'
-                        f'!h [命令]\n'
-                        f'  显示命令用法'
-                    )
+                    await COMMAND_HANDLER[command](
+                        bot, event, args, bot_config.command_config[command])
+
+            try:
+                # 超出并发或频率限制时立即回复，不排队等待
+                reply = await scheduler.run(
+                    command, event.sender.id, group, handler)
+                if reply is not None:
+                    await bot.send(event, reply)
+            except ArgumentException as exc:
+                await bot.send(
+                    event, f'{exc}\n{bot_config.router.usage[command]}')
         except Exception:
-            await bot.send_friend_message(su, traceback.format_exc())
+            await bot.send_friend_message(
+                bot_config.su, traceback.format_exc())
             logger.exception('Exception on message %s from %s',
                              event.message_chain, event.sender)
             raise
 
+    bot.add_background_task(monitor_loop_lag)
+
     @bot.add_background_task
     async def _():
-        nonlocal bot, su
-        ctf_config = config['ctf']
-        broadcast_config = ctf_config['broadcast']
-        if not ctf_config['enabled']:
-            return
+        # 没有 inotify 等依赖，定期检查修改时间
+        try:
+            mtime = os.stat(CONFIG_PATH).st_mtime_ns
+        except OSError:
+            mtime = None
+        while True:
+            await asyncio.sleep(CONFIG_POLL_SECOND)
+            try:
+                new_mtime = os.stat(CONFIG_PATH).st_mtime_ns
+            except OSError:
+                continue
+            if new_mtime != mtime:
+                mtime = new_mtime
+                try:
+                    await reload_config()
+                except Exception:  # pylint: disable=broad-except
+                    # 继续检查之后的修改
+                    logger.exception('Failed to reload config')
+
+    @bot.add_background_task
+    async def _():
+        nonlocal bot, game_status
         try:
-            game_status = CTFGameStatus(
-                bot=bot, gosessid=ctf_config['gosessid'], **broadcast_config)
             while True:
+                # 禁用时等待配置重新加载
+                while not current.ctf['enabled']:
+                    await asyncio.sleep(CONFIG_POLL_SECOND)
+                if game_status is None:
+                    game_status = CTFGameStatus(
+                        bot=bot, gosessid=current.ctf['gosessid'],
+                        **current.ctf['broadcast'])
                 while True:
                     try:
-                        await game_status.query()
+                        with CTF_POLL_DURATION.time(('query',)):
+                            await game_status.query()
                     except httpx.TimeoutException:
                         logger.warning('Timeout')
+                        CTF_POLL_TIMEOUTS.inc(('query',))
                     else:
                         break
-                    await asyncio.sleep(ctf_config['wait_second'])
-                while True:
-                    await asyncio.sleep(ctf_config['wait_second'])
+                    await asyncio.sleep(current.ctf['wait_second'])
+                while current.ctf['enabled']:
+                    await asyncio.sleep(current.ctf['wait_second'])
                     try:
-                        await game_status.check()
+                        with CTF_POLL_DURATION.time(('check',)):
+                            await game_status.check()
                     except httpx.TimeoutException:
                         logger.warning('Timeout')
+                        CTF_POLL_TIMEOUTS.inc(('check',))
                         break
         except Exception:
-            await bot.send_friend_message(su, traceback.format_exc())
+            await bot.send_friend_message(current.su, traceback.format_exc())
             logger.exception('Exception in background task')
             raise
 
@@ -1,55 +1,177 @@
 import os
+import json
+import asyncio
 from pathlib import Path
-from sqlite3 import Connection, Cursor, connect, Row
-from sys import argv
-from re import match as re_match
-from gzip import decompress
+from sqlite3 import Connection, connect, Row, sqlite_version_info
+from sys import argv, byteorder
+from re import compile as re_compile
+from zlib import decompressobj, MAX_WBITS
+from codecs import getincrementaldecoder
 from traceback import print_exc
-from typing import Optional
-from threading import Lock
+from typing import Any, Callable, Iterable, Iterator, Optional, TypeVar
+from threading import BoundedSemaphore, Lock
+from queue import Empty, SimpleQueue
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
+from hashlib import sha1
+from shutil import copyfile
+from difflib import SequenceMatcher
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from time import perf_counter
+from mmap import mmap, ACCESS_READ
+from array import array
 
 from mirai import Mirai, MessageEvent
+from starlette.requests import Request
+from starlette.responses import JSONResponse
 import httpx
 
-from nk_bot00.exception import ArgumentException
-from nk_bot00.util import forward_message
+from nk_bot00.exception import ArgumentException, BusyException
+from nk_bot00.util import forward_message, get_logger
 import nk_bot00
 
 MOJANG_METADATA_URL = 'https://piston-meta.mojang.com/mc/game/version_manifest_v2.json'
 YARN_METADATA_URL = 'https://meta.fabricmc.net/v2/versions/yarn'
 YARN_MAPPING_URL = 'https://maven.fabricmc.net/net/fabricmc/yarn/%s/yarn-%s-tiny.gz'
 
-
-CLIENT = httpx.Client(headers={
+SEARCH_LIMIT = 10
+'''搜索时显示的结果数'''
+SEARCH_CANDIDATES = 200
+'''搜索时从全文索引中取出并重新排序的候选数'''
+SEARCH_SQLITE_VERSION = (3, 34, 0)
+'''全文索引的 trigram 分词器需要的最低 SQLite 版本'''
+MEMBERS_PER_NODE = 10
+'''列出类成员时每条消息的成员数'''
+MEMBERS_NODE_LIMIT = 50
+'''列出类成员时的最大消息数'''
+
+T = TypeVar('T')
+
+POOL_SIZE = 4
+'''每个版本的只读连接数，同时也是查询线程数'''
+EXECUTOR = ThreadPoolExecutor(max_workers=POOL_SIZE,
+                              thread_name_prefix='mapping')
+EXECUTOR_LIMIT = POOL_SIZE * 16
+'''线程池中排队与执行的查询数上限，足够同时追溯几次所有版本'''
+EXECUTOR_SLOTS = BoundedSemaphore(EXECUTOR_LIMIT)
+
+
+HEADERS = {
     'User-Agent': f'nk_bot00/{nk_bot00.__version__}'
     f' (https://github.com/NKID00/nk_bot00)'
     f' httpx/{httpx.__version__}'
-})
+}
+MAX_CONNECTIONS = 8
+CACHE_PATH = Path('mapping') / 'cache'
+CHUNK_SIZE = 64 * 1024
+
+
+def file_identity(path: Path) -> tuple[int, int]:
+    '''(Inode, 修改时间)，同名文件被替换或重写后改变'''
+    stat = os.stat(path)
+    return stat.st_ino, stat.st_mtime_ns
 
 
 class Mapping:
     yarn_version: str
-    c: Connection
+    path: Path
+    identity: tuple[int, int]
+    '''打开时数据库文件的标识'''
+    pool: SimpleQueue
+    opened: int
+    '''已打开的连接数，不超过 POOL_SIZE'''
+    closed: bool
     lock: Lock
-
-    def __init__(self, version: str) -> None:
-        for f in next(os.walk('mapping'))[2]:
-            if f.startswith(f'{version}+'):
-                break
-        else:
-            raise ArgumentException('未知的 mc 版本')
-        self.c = connect(
-            Path('mapping') / f,
-            check_same_thread=False,
-            isolation_level=None
-        )
-        self.yarn_version = f.rsplit('.', 1)[0]
-        self.c.row_factory = Row
+    compact: Optional['CompactMapping']
+    '''数据库旁的紧凑映射文件，存在时精确查找不经过数据库'''
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.yarn_version = path.name.rsplit('.', 1)[0]
+        self.identity = file_identity(path)
+        self.pool = SimpleQueue()
+        self.opened = 0
+        self.closed = False
         self.lock = Lock()
-
-    def execute(self, sql: str, args: tuple[str]) -> Cursor:
+        try:
+            self.compact = CompactMapping(path.with_suffix('.bin'))
+        except (OSError, ValueError):
+            self.compact = None
+
+    def connect(self) -> Connection:
+        # 映射数据库生成后不再修改，以 immutable 打开可省去文件锁
+        c = connect(
+            f'{self.path.absolute().as_uri()}?mode=ro&immutable=1',
+            uri=True,
+            check_same_thread=False
+        )
+        c.row_factory = Row
+        return c
+
+    @contextmanager
+    def connection(self) -> Iterator[Connection]:
+        c: Optional[Connection] = None
+        if not self.closed:
+            try:
+                c = self.pool.get_nowait()
+            except Empty:
+                # 连接按需打开，达到上限后等待其他查询归还
+                with self.lock:
+                    create = self.opened < POOL_SIZE
+                    if create:
+                        self.opened += 1
+                c = self.connect() if create else self.pool.get()
+            if c is None:
+                # 等待时被关闭，唤醒下一个等待的查询
+                self.pool.put(None)
+        if c is None:
+            # 已关闭时不再使用连接池，临时打开一个连接
+            c = self.connect()
+        try:
+            yield c
+        finally:
+            if self.closed:
+                c.close()
+            else:
+                self.pool.put(c)
+
+    def warm_up(self) -> None:
+        '''打开所有连接并将数据库文件读入系统页缓存'''
+        with self.lock:
+            if self.closed:
+                return
+            count = POOL_SIZE - self.opened
+            self.opened = POOL_SIZE
+        for _ in range(count):
+            c = self.connect()
+            c.execute('SELECT 1 FROM sqlite_master LIMIT 1;').fetchone()
+            self.pool.put(c)
+        paths = [self.path]
+        if self.compact is not None:
+            paths.append(self.path.with_suffix('.bin'))
+        for path in paths:
+            with open(path, 'rb') as f:
+                while len(f.read(CHUNK_SIZE)) > 0:
+                    pass
+
+    def close(self) -> None:
+        '''关闭空闲连接，正在使用的连接归还时关闭
+
+        之后的查询各自临时打开连接，紧凑映射文件在不再被引用时自动解除映射'''
         with self.lock:
-            return self.c.execute(sql, args)
+            if self.closed:
+                return
+            self.closed = True
+        while True:
+            try:
+                c = self.pool.get_nowait()
+            except Empty:
+                break
+            if c is not None:
+                c.close()
+        # 唤醒正在等待连接的查询
+        self.pool.put(None)
 
     def find(
         self,
@@ -57,96 +179,329 @@ class Mapping:
         type_: Optional[str],
         namespace: Optional[str]
     ) -> Optional[list[str]]:
-        if type_ is None:
-            for t in ('class', 'field', 'method'):
-                result = self.find(name, t, namespace)
-                if result is not None:
-                    return result
-            return None
-        if namespace is None:
-            for ns in ('official', 'intermediary', 'mojang', 'yarn'):
-                result = self.find(name, type_, ns)
-                if result is not None:
-                    return result
-            return None
+        if self.compact is not None:
+            return self.compact.find(name, type_, namespace)
+        with self.connection() as c:
+            return self.find_with(c, name, type_, namespace)
 
-        if type_ == 'class':
-            # TODO: if name.startswith('.')
-            row = self.execute(
-                f'SELECT * FROM class WHERE {namespace} = ? COLLATE NOCASE LIMIT 1;',
-                (name,)
-            ).fetchone()
-            if row is None:
-                row = self.execute(
-                    f'SELECT * FROM class WHERE {namespace} LIKE ? COLLATE NOCASE LIMIT 1;',
-                    (f'%.{name}',)
-                ).fetchone()
-            if row is None:
+    def find_many(
+        self,
+        names: list[str],
+        type_: Optional[str],
+        namespace: Optional[str]
+    ) -> list[Optional[list[str]]]:
+        '''在同一个连接中依次查找多个名称'''
+        if self.compact is not None:
+            return [self.compact.find(name, type_, namespace) for name in names]
+        with self.connection() as c:
+            return [self.find_with(c, name, type_, namespace) for name in names]
+
+    def find_with(
+        self,
+        c: Connection,
+        name: str,
+        type_: Optional[str],
+        namespace: Optional[str]
+    ) -> Optional[list[str]]:
+        # TODO: if name.startswith('.')
+        found = c.execute(resolve_sql(type_, namespace), (name,)).fetchone()
+        if found is None:
+            return None
+        row = c.execute(
+            f'SELECT * FROM {found["type"]} WHERE rowid = ?;', (found['id'],)
+        ).fetchone()
+        if found['type'] == 'class':
+            return render_class(self.yarn_version, row, found['candidate'])
+        row_class = c.execute(
+            'SELECT * FROM class WHERE rowid = ?;', (found['class_id'],)
+        ).fetchone()
+        return render_member(self.yarn_version, found['type'], row, row_class)
+
+    def members(
+        self,
+        name: str,
+        type_: Optional[str],
+        namespace: Optional[str]
+    ) -> Optional[list[str]]:
+        '''列出类的字段与方法，[类型] 为 field 或 method 时只列出一种'''
+        with self.connection() as c:
+            found = c.execute(
+                resolve_sql('class', namespace), (name,)).fetchone()
+            if found is None:
                 return None
-
-            return [
-                f'yarn {self.yarn_version}',
-                f'official: {row["official"]}',
-                f'intermediary: {row["intermediary"]}',
-                f'mojang: {row["mojang"]}',
-                f'yarn: {row["yarn"]}',
-            ]
-
-        if type_ == 'field':
-            row = self.execute(
-                f'SELECT * FROM field WHERE {namespace} = ? COLLATE NOCASE LIMIT 1;',
-                (name,)
+            row_class = c.execute(
+                'SELECT * FROM class WHERE rowid = ?;', (found['id'],)
             ).fetchone()
-            if row is None:
+            # 主键以 official_class 开头，按类查找成员使用主键索引
+            members = []
+            for t in ('field', 'method'):
+                if type_ in (None, 'class', t):
+                    members.extend((t, row) for row in c.execute(
+                        f'SELECT * FROM {t} WHERE official_class = ? '
+                        f'ORDER BY yarn, mojang, official;',
+                        (row_class['official'],)
+                    ))
+        header = render_class(self.yarn_version, row_class, found['candidate'])
+        header.append(f'共 {len(members)} 个成员')
+        limit = MEMBERS_PER_NODE * MEMBERS_NODE_LIMIT
+        if len(members) > limit:
+            header.append(f'仅显示前 {limit} 个')
+            members = members[:limit]
+        result = ['\n'.join(header)]
+        for i in range(0, len(members), MEMBERS_PER_NODE):
+            result.append('\n'.join(
+                render_member_line(t, row)
+                for t, row in members[i:i + MEMBERS_PER_NODE]
+            ))
+        return result
+
+    def trace_key(
+        self,
+        name: str,
+        type_: Optional[str],
+        namespace: Optional[str]
+    ) -> Optional[tuple[str, str, str]]:
+        '''查找映射并返回用于在其他版本中查找的 (类型, 命名空间, 名称)
+
+        优先使用跨版本不变的 intermediary 名称'''
+        with self.connection() as c:
+            found = c.execute(
+                resolve_sql(type_, namespace), (name,)).fetchone()
+            if found is None:
                 return None
-
-            row_class = self.execute(
-                'SELECT * FROM class WHERE official = ? LIMIT 1;',
-                (row['official_class'],)
+            row = c.execute(
+                f'SELECT * FROM {found["type"]} WHERE rowid = ?;',
+                (found['id'],)
             ).fetchone()
-            if row_class is None:
-                return None
-
-            return [
-                f'yarn {self.yarn_version}',
-                f'official: {row["official_class"]}.{row["official"]}',
-                f'field descriptor: {row["field_descriptor"]}',
-                f'intermediary: {row["intermediary"]}',
-                f'mojang: {row_class["mojang"]}.{row["mojang"]}',
-                f'yarn: {row_class["yarn"]}.{row["yarn"]}'
-            ]
+        for ns in ('intermediary', 'mojang', 'yarn', 'official'):
+            if row[ns] is not None:
+                return found['type'], ns, row[ns]
+        return None
 
-        if type_ == 'method':
-            row = self.execute(
-                f'SELECT * FROM method WHERE {namespace} = ? COLLATE NOCASE LIMIT 1;',
+    def trace(
+        self,
+        type_: str,
+        namespace: str,
+        name: str
+    ) -> Optional[tuple[str, str]]:
+        '''按名称精确查找，返回 (yarn 名称, mojang 名称)'''
+        with self.connection() as c:
+            if type_ == 'class':
+                row = c.execute(
+                    f'SELECT yarn, mojang FROM class '
+                    f'WHERE {namespace} = ? COLLATE NOCASE LIMIT 1;',
+                    (name,)
+                ).fetchone()
+                if row is None:
+                    return None
+                return f'{row["yarn"]}', f'{row["mojang"]}'
+            row = c.execute(
+                f'SELECT {type_}.yarn, {type_}.mojang, '
+                f'class.yarn AS class_yarn, class.mojang AS class_mojang '
+                f'FROM {type_} '
+                f'JOIN class ON class.official = {type_}.official_class '
+                f'WHERE {type_}.{namespace} = ? COLLATE NOCASE LIMIT 1;',
                 (name,)
             ).fetchone()
             if row is None:
                 return None
+            return (f'{row["class_yarn"]}.{row["yarn"]}',
+                    f'{row["class_mojang"]}.{row["mojang"]}')
 
-            row_class = self.execute(
-                'SELECT * FROM class WHERE official = ? LIMIT 1;',
-                (row['official_class'],)
-            ).fetchone()
-            if row_class is None:
-                return None
+    def search(
+        self,
+        query: str,
+        type_: Optional[str],
+        namespace: Optional[str]
+    ) -> Optional[list[str]]:
+        with self.connection() as c:
+            return self.search_with(c, query, type_, namespace)
 
-            return [
-                f'yarn {self.yarn_version}',
-                f'official: {row["official_class"]}.{row["official"]}',
-                f'method descriptor: {row["method_descriptor"]}',
-                f'intermediary: {row["intermediary"]}',
-                f'mojang: {row_class["mojang"]}.{row["mojang"]}'
-                f'{map_method_mojang(row["method_descriptor"], self.c)}',
-                f'mojang mixin: "{row["mojang"]}'
-                f'{map_mixin_mojang(row["method_descriptor"], self.c)}"',
-                f'yarn: {row_class["yarn"]}.{row["yarn"]}'
-                f'{map_method_yarn(row["method_descriptor"], self.c)}',
-                f'yarn mixin: "{row["yarn"]}{map_mixin_yarn(row["method_descriptor"], self.c)}"'
-            ]
-        return None
+    def search_with(
+        self,
+        c: Connection,
+        query: str,
+        type_: Optional[str],
+        namespace: Optional[str]
+    ) -> Optional[list[str]]:
+        if sqlite_version_info < SEARCH_SQLITE_VERSION:
+            raise ArgumentException('当前 SQLite 版本不支持搜索')
+        # 类只索引了名称的最后一段
+        key = query.rsplit('.', 1)[-1].lower()
+        if len(key) < 3:
+            raise ArgumentException('名称过短')
+        # 任意三元组匹配即为候选，容许拼写错误
+        match = ' OR '.join(
+            '"' + key[i:i + 3].replace('"', '""') + '"'
+            for i in range(len(key) - 2)
+        )
+        if namespace is not None:
+            match = f'{namespace} : ({match})'
+        types = OPTIONS_TYPE if type_ is None else (type_,)
+        candidates: dict[str, list[int]] = {t: [] for t in types}
+        for (rowid,) in c.execute(
+            f'SELECT rowid FROM search WHERE search MATCH ? '
+            f'AND rowid % 3 IN ({", ".join(str(OPTIONS_TYPE.index(t)) for t in types)}) '
+            f'ORDER BY rank LIMIT ?;',
+            (match, SEARCH_CANDIDATES)
+        ):
+            candidates[OPTIONS_TYPE[rowid % 3]].append(rowid // 3)
+
+        namespaces = OPTIONS_NAMESPACE if namespace is None else (namespace,)
+        ranked: list[tuple[float, str]] = []
+        for t, rowids in candidates.items():
+            if len(rowids) == 0:
+                continue
+            placeholders = ', '.join('?' * len(rowids))
+            if t == 'class':
+                for row in c.execute(
+                    f'SELECT * FROM class WHERE rowid IN ({placeholders});',
+                    rowids
+                ):
+                    score = max(similarity(key, row[f'{ns}_short'])
+                                for ns in namespaces)
+                    ranked.append((score, '\n'.join([
+                        'class',
+                        f'official: {row["official"]}',
+                        f'intermediary: {row["intermediary"]}',
+                        f'mojang: {row["mojang"]}',
+                        f'yarn: {row["yarn"]}'
+                    ])))
+                continue
+            for row in c.execute(
+                f'SELECT {t}.*, class.mojang AS class_mojang, '
+                f'class.yarn AS class_yarn FROM {t} '
+                f'JOIN class ON class.official = {t}.official_class '
+                f'WHERE {t}.rowid IN ({placeholders});',
+                rowids
+            ):
+                score = max(similarity(key, row[ns]) for ns in namespaces)
+                if t == 'method':
+                    signature = {ns: row[f'{ns}_signature']
+                                 for ns in ('mojang', 'yarn')}
+                else:
+                    signature = {'mojang': '', 'yarn': ''}
+                ranked.append((score, '\n'.join([
+                    t,
+                    f'official: {row["official_class"]}.{row["official"]}',
+                    f'intermediary: {row["intermediary"]}',
+                    f'mojang: {row["class_mojang"]}.{row["mojang"]}'
+                    f'{signature["mojang"]}',
+                    f'yarn: {row["class_yarn"]}.{row["yarn"]}'
+                    f'{signature["yarn"]}'
+                ])))
+        if len(ranked) == 0:
+            return None
+        ranked.sort(key=lambda item: item[0], reverse=True)
+        return [f'yarn {self.yarn_version}'] + [
+            node for _, node in ranked[:SEARCH_LIMIT]]
+
+
+def render_class(yarn_version: str, row: Any, candidate: int) -> list[str]:
+    result = [
+        f'yarn {yarn_version}',
+        f'official: {row["official"]}',
+        f'intermediary: {row["intermediary"]}',
+        f'mojang: {row["mojang"]}',
+        f'yarn: {row["yarn"]}',
+    ]
+    if candidate > 1:
+        result.append(f'共 {candidate} 个匹配，仅显示第一个')
+    return result
+
+
+def render_member(
+    yarn_version: str,
+    type_: str,
+    row: Any,
+    row_class: Any
+) -> list[str]:
+    if type_ == 'field':
+        return [
+            f'yarn {yarn_version}',
+            f'official: {row["official_class"]}.{row["official"]}',
+            f'field descriptor: {row["field_descriptor"]}',
+            f'intermediary: {row["intermediary"]}',
+            f'mojang: {row_class["mojang"]}.{row["mojang"]}',
+            f'yarn: {row_class["yarn"]}.{row["yarn"]}'
+        ]
+    return [
+        f'yarn {yarn_version}',
+        f'official: {row["official_class"]}.{row["official"]}',
+        f'method descriptor: {row["method_descriptor"]}',
+        f'intermediary: {row["intermediary"]}',
+        f'mojang: {row_class["mojang"]}.{row["mojang"]}'
+        f'{row["mojang_signature"]}',
+        f'mojang mixin: "{row["mojang"]}{row["mojang_mixin"]}"',
+        f'yarn: {row_class["yarn"]}.{row["yarn"]}{row["yarn_signature"]}',
+        f'yarn mixin: "{row["yarn"]}{row["yarn_mixin"]}"'
+    ]
+
+
+def render_member_line(type_: str, row: Any) -> str:
+    '''列出类成员时的一行，不包含所属类'''
+    if type_ == 'field':
+        return (f'{row["intermediary"]}\n'
+                f'  yarn: {row["yarn"]}\n'
+                f'  mojang: {row["mojang"]}')
+    return (f'{row["intermediary"]}\n'
+            f'  yarn: {row["yarn"]}{row["yarn_signature"]}\n'
+            f'  mojang: {row["mojang"]}{row["mojang_signature"]}')
+
+
+def similarity(key: str, name: Optional[str]) -> float:
+    '''搜索结果的排序依据，完全匹配优先于前缀匹配，其次按相似度'''
+    if name is None:
+        return 0.0
+    name = name.lower()
+    if name == key:
+        return 3.0
+    score = SequenceMatcher(None, key, name).ratio()
+    if name.startswith(key):
+        score += 1.0
+    return score
+
+
+@lru_cache(maxsize=None)
+def resolve_sql(type_: Optional[str], namespace: Optional[str]) -> str:
+    '''生成一次查找所有候选的 SQL，按优先级返回第一个匹配
+
+    优先级与逐个查找时相同：类型按 class、field、method，命名空间按
+    official、intermediary、mojang、yarn，类的完整名称优先于最后一段'''
+    branches = []
+    for t in OPTIONS_TYPE if type_ is None else (type_,):
+        for ns in OPTIONS_NAMESPACE if namespace is None else (namespace,):
+            priority = len(branches)
+            if t == 'class':
+                branches.append(
+                    f'SELECT {priority} AS priority, \'class\' AS type, '
+                    f'rowid AS id, NULL AS class_id, 1 AS candidate '
+                    f'FROM class WHERE {ns} = ?1 COLLATE NOCASE LIMIT 1'
+                )
+                # 只给出类名时按类名最后一段查找
+                branches.append(
+                    f'SELECT {priority + 1} AS priority, \'class\' AS type, '
+                    f'rowid AS id, NULL AS class_id, '
+                    f'COUNT(*) OVER () AS candidate '
+                    f'FROM class WHERE {ns}_short = ?1 COLLATE NOCASE '
+                    f'ORDER BY {ns} LIMIT 1'
+                )
+            else:
+                branches.append(
+                    f'SELECT {priority} AS priority, \'{t}\' AS type, '
+                    f'{t}.rowid AS id, class.rowid AS class_id, '
+                    f'1 AS candidate FROM {t} '
+                    f'JOIN class ON class.official = {t}.official_class '
+                    f'WHERE {t}.{ns} = ?1 COLLATE NOCASE LIMIT 1'
+                )
+    return (
+        'SELECT * FROM ('
+        + ' UNION ALL '.join(f'SELECT * FROM ({b})' for b in branches)
+        + ') ORDER BY priority LIMIT 1;'
+    )
 
 
+OPTIONS_MODE = ('search', 'trace', 'members')
 OPTIONS_TYPE = ('class', 'field', 'method')
 OPTIONS_NAMESPACE = ('official', 'intermediary', 'mojang', 'yarn')
 MCVERSION = {
@@ -169,29 +524,526 @@ MCVERSION_MAX = (
     else f'1.{MCVERSION_MAX_K}'
 )
 
-MAPPINGS: dict[str, Mapping] = {}
+COMPACT_MAGIC = b'NKMAP\x00\x03\x00'
+COMPACT_NULL = 0xFFFFFFFF
+COMPACT_COLUMNS = {
+    'class': (
+        'official', 'intermediary', 'mojang', 'yarn',
+        'official_short', 'intermediary_short', 'mojang_short', 'yarn_short'
+    ),
+    'field': (
+        'class_id', 'official_class', 'official', 'field_descriptor',
+        'intermediary', 'mojang', 'yarn'
+    ),
+    'method': (
+        'class_id', 'official_class', 'official', 'method_descriptor',
+        'intermediary', 'mojang', 'yarn', 'mojang_signature', 'mojang_mixin',
+        'yarn_signature', 'yarn_mixin'
+    ),
+}
+'''{Type: (Column, ...), ...}，class_id 为所属类的记录序号，其余为字符串序号'''
+COMPACT_KEYS = tuple(
+    (t, column)
+    for t in OPTIONS_TYPE
+    for ns in OPTIONS_NAMESPACE
+    for column in ((ns, f'{ns}_short') if t == 'class' else (ns,))
+)
+'''按查找优先级排列的 (Type, Column)'''
+COMPACT_SECTIONS = (
+    ('offsets', 'strings') + OPTIONS_TYPE
+    + ('folded_offsets', 'folded', 'groups', 'keys')
+)
+COMPACT_BLOBS = ('strings', 'folded')
+'''按字节读取的段，其余为 uint32 数组'''
+
+
+@lru_cache(maxsize=None)
+def compact_key_indices(
+    type_: Optional[str],
+    namespace: Optional[str]
+) -> tuple[int, ...]:
+    '''符合条件的 COMPACT_KEYS 序号，按优先级排列'''
+    return tuple(
+        i for i, (t, column) in enumerate(COMPACT_KEYS)
+        if (type_ is None or t == type_)
+        and (namespace is None or column.split('_')[0] == namespace)
+    )
+
+
+class CompactMapping:
+    '''只读的紧凑映射文件，通过内存映射二分查找
+
+    文件由字符串表、各类型的定长记录、去重排序的小写键与键对应的记录组成，
+    所有类型与命名空间共用一组键，一次二分查找即可找到所有候选，
+    多个进程打开同一文件时共享系统页缓存'''
+    yarn_version: str
+    map: mmap
+    offsets: memoryview
+    '''字符串 i 位于 strings[offsets[i]:offsets[i + 1]]'''
+    strings: memoryview
+    records: dict[str, memoryview]
+    '''{Type: [Column, ...] * N, ...}'''
+    folded_offsets: memoryview
+    '''小写键 i 位于 map[folded_start + folded_offsets[i]:...]，按字节排序且不重复'''
+    folded_start: int
+    groups: memoryview
+    '''小写键 i 对应 keys 中第 groups[i] 到 groups[i + 1] 项'''
+    keys: memoryview
+    '''[KeyIndex, RecordIndex] * N，KeyIndex 为 COMPACT_KEYS 的序号，
+    同一小写键内按 KeyIndex 即 resolve_sql 的优先级排列'''
+
+    def __init__(self, path: Path) -> None:
+        self.yarn_version = path.name.rsplit('.', 1)[0]
+        with open(path, 'rb') as f:
+            self.map = mmap(f.fileno(), 0, access=ACCESS_READ)
+        view = memoryview(self.map)
+        if view[:len(COMPACT_MAGIC)] != COMPACT_MAGIC or byteorder != 'little':
+            raise ValueError('Unsupported compact mapping')
+        start = len(COMPACT_MAGIC)
+        header = view[start:start + 8 * len(COMPACT_SECTIONS)].cast('I')
+        sections = {}
+        for i, name in enumerate(COMPACT_SECTIONS):
+            section = view[header[2 * i]:header[2 * i] + header[2 * i + 1]]
+            sections[name] = (section if name in COMPACT_BLOBS
+                              else section.cast('I'))
+        self.offsets = sections['offsets']
+        self.strings = sections['strings']
+        self.records = {t: sections[t] for t in OPTIONS_TYPE}
+        self.folded_offsets = sections['folded_offsets']
+        self.folded_start = header[2 * COMPACT_SECTIONS.index('folded')]
+        self.groups = sections['groups']
+        self.keys = sections['keys']
+
+    def string(self, ref: int) -> Optional[str]:
+        if ref == COMPACT_NULL:
+            return None
+        return str(self.strings[self.offsets[ref]:self.offsets[ref + 1]], 'utf-8')
+
+    def row(self, type_: str, index: int) -> dict[str, Any]:
+        columns = COMPACT_COLUMNS[type_]
+        record = self.records[type_][
+            index * len(columns):(index + 1) * len(columns)].tolist()
+        return {
+            column: ref if column == 'class_id' else self.string(ref)
+            for column, ref in zip(columns, record)
+        }
+
+    def group(self, key: bytes) -> Optional[tuple[int, int]]:
+        '''返回与小写键相同的 keys 范围'''
+        # 直接比较 mmap 切片，键已在生成时转为小写
+        folded = self.map
+        offsets = self.folded_offsets
+        start = self.folded_start
+        low = 0
+        high = len(offsets) - 1
+        while low < high:
+            middle = (low + high) // 2
+            if folded[start + offsets[middle]:
+                      start + offsets[middle + 1]] < key:
+                low = middle + 1
+            else:
+                high = middle
+        if (low == len(offsets) - 1
+                or folded[start + offsets[low]:start + offsets[low + 1]] != key):
+            return None
+        return self.groups[low], self.groups[low + 1]
+
+    def bisect(self, key_index: int, low: int, high: int) -> int:
+        '''返回 [low, high) 中第一个 KeyIndex 不小于 key_index 的位置'''
+        keys = self.keys
+        while low < high:
+            middle = (low + high) // 2
+            if keys[2 * middle] < key_index:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def find(
+        self,
+        name: str,
+        type_: Optional[str],
+        namespace: Optional[str]
+    ) -> Optional[list[str]]:
+        group = self.group(name.encode('utf-8').lower())
+        if group is None:
+            return None
+        low, high = group
+        keys = self.keys
+        for key_index in compact_key_indices(type_, namespace):
+            # 跳过不符合条件的整组，不逐项比较
+            low = self.bisect(key_index, low, high)
+            if low == high:
+                return None
+            if keys[2 * low] != key_index:
+                continue
+            t = COMPACT_KEYS[key_index][0]
+            row = self.row(t, keys[2 * low + 1])
+            if t != 'class':
+                return render_member(
+                    self.yarn_version, t, row,
+                    self.row('class', row['class_id']))
+            candidate = self.bisect(key_index + 1, low, high) - low
+            return render_class(self.yarn_version, row, candidate)
+        return None
+
+
+BATCH_LIMIT = 20
+'''一次查找的最大名称数'''
+HTTP_BATCH_LIMIT = 1000
+'''通过 HTTP 一次查找的最大名称数'''
+MAX_OPEN = 4
+'''默认同时打开的版本数'''
+RESULT_CACHE_SIZE = 1024
+'''默认缓存的查询结果数'''
+
+
+def find_database(version: str) -> Optional[Path]:
+    for f in next(os.walk('mapping'))[2]:
+        if f.startswith(f'{version}+') and f.endswith('.db'):
+            return Path('mapping') / f
+    return None
+
+
+class ResultCache:
+    '''缓存最近的查询结果（包括未找到），数据库被替换时失效'''
+    size: int
+    results: OrderedDict[tuple, Optional[list[str]]]
+    '''{(McVersion, FileIdentity, Mode, Name, Type, Namespace): Result, ...}'''
+    hit: int
+    miss: int
+    lock: Lock
+
+    MISSING = object()
+
+    def __init__(self, size: int = RESULT_CACHE_SIZE) -> None:
+        self.size = size
+        self.results = OrderedDict()
+        self.hit = 0
+        self.miss = 0
+        self.lock = Lock()
+
+    def get(self, key: tuple) -> Any:
+        '''返回缓存的结果，不存在时返回 ResultCache.MISSING'''
+        with self.lock:
+            result = self.results.get(key, self.MISSING)
+            if result is self.MISSING:
+                self.miss += 1
+            else:
+                self.hit += 1
+                self.results.move_to_end(key)
+            return result
+
+    def put(self, key: tuple, result: Optional[list[str]]) -> None:
+        with self.lock:
+            if self.size <= 0:
+                return
+            self.results[key] = result
+            self.results.move_to_end(key)
+            while len(self.results) > self.size:
+                self.results.popitem(last=False)
+
+    def invalidate(self, version: str) -> None:
+        with self.lock:
+            for key in [k for k in self.results if k[0] == version]:
+                del self.results[key]
+
+    def configure(self, size: int) -> None:
+        with self.lock:
+            self.size = size
+            while len(self.results) > max(size, 0):
+                self.results.popitem(last=False)
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return {
+                'size': len(self.results),
+                'hit': self.hit,
+                'miss': self.miss,
+            }
+
+
+RESULTS = ResultCache()
+
+
+def validate_mapping_config(config: Any) -> None:
+    '''检查 mapping 命令的配置，有错误时抛出 ValueError'''
+    if not isinstance(config, dict):
+        raise ValueError('command_config.mapping is not an object')
+    max_open = config.get('max_open', MAX_OPEN)
+    if not isinstance(max_open, int) or isinstance(max_open, bool) or max_open < 1:
+        raise ValueError('command_config.mapping.max_open is not a positive integer')
+    result_cache = config.get('result_cache', RESULT_CACHE_SIZE)
+    if (not isinstance(result_cache, int) or isinstance(result_cache, bool)
+            or result_cache < 0):
+        raise ValueError(
+            'command_config.mapping.result_cache is not a non-negative integer')
+    warm_up = config.get('warm_up', [MCVERSION_MAX])
+    if not isinstance(warm_up, list) or any(
+            v not in OPTIONS_MCVERSION for v in warm_up):
+        raise ValueError(
+            'command_config.mapping.warm_up is not a list of mc versions')
+
+
+class MappingRegistry:
+    '''索引 mapping 目录中的数据库，按最近使用保留有限个已打开的版本'''
+    path: Path
+    max_open: int
+    files: dict[str, Path]
+    '''{McVersion: Path, ...}'''
+    mtime: Optional[int]
+    '''建立索引时 mapping 目录的修改时间'''
+    mappings: OrderedDict[str, Mapping]
+    '''{McVersion: Mapping, ...}，最近使用的在最后'''
+    lock: Lock
+
+    def __init__(self, path: Path, max_open: int = MAX_OPEN) -> None:
+        self.path = path
+        self.max_open = max_open
+        self.files = {}
+        self.mtime = None
+        self.mappings = OrderedDict()
+        self.lock = Lock()
+
+    def refresh(self) -> None:
+        '''目录内容变化（如数据库被新的 yarn 版本替换）时重新索引'''
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self.mtime:
+            return
+        self.mtime = mtime
+        files = self.files
+        self.files = {}
+        if mtime is not None:
+            for f in next(os.walk(self.path))[2]:
+                if f.endswith('.db') and '+' in f:
+                    self.files[f.split('+', 1)[0]] = self.path / f
+        for version, path in files.items():
+            if self.files.get(version) != path:
+                RESULTS.invalidate(version)
+
+    def locate(self, version: str) -> tuple[Path, tuple[int, int]]:
+        '''返回数据库路径与文件标识，文件刚被替换时重新索引'''
+        self.refresh()
+        for retry in (False, True):
+            if retry:
+                self.mtime = None
+                self.refresh()
+            path = self.files.get(version)
+            if path is None:
+                continue
+            try:
+                return path, file_identity(path)
+            except FileNotFoundError:
+                continue
+        raise ArgumentException('未知的 mc 版本')
+
+    def get(self, version: str) -> Mapping:
+        with self.lock:
+            path, identity = self.locate(version)
+            mapping = self.mappings.get(version)
+            if mapping is not None:
+                # 同名文件被重新生成（如 mapping upgrade）时路径不变，比较文件标识
+                if mapping.identity == identity:
+                    self.mappings.move_to_end(version)
+                    return mapping
+                # 已被替换，正在进行的查询仍可读取已删除的旧文件
+                del self.mappings[version]
+                mapping.close()
+                RESULTS.invalidate(version)
+            mapping = Mapping(path)
+            self.mappings[version] = mapping
+            while len(self.mappings) > self.max_open:
+                self.mappings.popitem(last=False)[1].close()
+            return mapping
+
+    def versions(self) -> list[str]:
+        with self.lock:
+            self.refresh()
+            return [v for v in OPTIONS_MCVERSION if v in self.files]
+
+    @contextmanager
+    def borrow(self, version: str) -> Iterator[Mapping]:
+        '''已打开的版本直接使用，否则临时打开，不挤占最近使用的版本'''
+        with self.lock:
+            path, identity = self.locate(version)
+            mapping = self.mappings.get(version)
+        if mapping is not None and mapping.identity == identity:
+            yield mapping
+            return
+        mapping = Mapping(path)
+        try:
+            yield mapping
+        finally:
+            mapping.close()
+
+    def configure(self, config: dict) -> None:
+        validate_mapping_config(config)
+        RESULTS.configure(config.get('result_cache', RESULT_CACHE_SIZE))
+        with self.lock:
+            self.max_open = config.get('max_open', MAX_OPEN)
+            while len(self.mappings) > self.max_open:
+                self.mappings.popitem(last=False)[1].close()
+
+    def warm_up(self, versions: list[str]) -> None:
+        '''预热常用版本，跳过尚未生成的版本'''
+        missing = []
+        warmed = 0
+        for version in versions:
+            if warmed >= self.max_open:
+                break
+            try:
+                mapping = self.get(version)
+            except ArgumentException:
+                missing.append(version)
+                continue
+            mapping.warm_up()
+            warmed += 1
+        if len(missing) > 0:
+            get_logger('mapping').warning(
+                'Skipping warm up of missing mapping %s', ', '.join(missing))
+
+
+MAPPINGS = MappingRegistry(Path('mapping'))
+
+
+async def run_query(func: Callable[..., T], *args: Any) -> T:
+    '''在线程池中执行查询，排队的查询过多时抛出 BusyException
+
+    取消或超时后线程中的查询仍会执行完，名额在执行完时才归还'''
+    if not EXECUTOR_SLOTS.acquire(blocking=False):
+        raise BusyException()
+    try:
+        future = EXECUTOR.submit(func, *args)
+    except BaseException:
+        EXECUTOR_SLOTS.release()
+        raise
+    future.add_done_callback(lambda _: EXECUTOR_SLOTS.release())
+    return await asyncio.wrap_future(future)
+
+
+def trace_version(
+    version: str,
+    type_: str,
+    namespace: str,
+    name: str
+) -> Optional[tuple[str, str]]:
+    with MAPPINGS.borrow(version) as mapping:
+        return mapping.trace(type_, namespace, name)
+
+
+async def trace_mapping(
+    name: str,
+    type_: Optional[str],
+    namespace: Optional[str],
+    mcversion: str
+) -> Optional[list[str]]:
+    '''在指定版本中查找映射，再在所有版本中并发查找同一映射'''
+    mapping = await run_query(MAPPINGS.get, mcversion)
+    key = await run_query(mapping.trace_key, name, type_, namespace)
+    if key is None:
+        return None
+    versions = await run_query(MAPPINGS.versions)
+    results = await asyncio.gather(*(
+        run_query(trace_version, version, *key) for version in versions
+    ))
+    # 合并名称相同的连续版本
+    groups: list[tuple[list[str], Optional[tuple[str, str]]]] = []
+    for version, result in zip(versions, results):
+        if len(groups) > 0 and groups[-1][1] == result:
+            groups[-1][0].append(version)
+        else:
+            groups.append(([version], result))
+    content = [f'{key[0]} {key[1]}: {key[2]}']
+    for group, result in groups:
+        span = group[0] if len(group) == 1 else f'{group[0]} - {group[-1]}'
+        if result is None:
+            content.append(f'{span}: 不存在')
+        else:
+            content.append(f'{span}\nyarn: {result[0]}\nmojang: {result[1]}')
+    return content
+
+
+async def lookup_mapping(
+    mapping: Mapping,
+    mcversion: str,
+    mode: str,
+    names: list[str],
+    type_: Optional[str],
+    namespace: Optional[str]
+) -> list[Optional[list[str]]]:
+    '''查找多个名称，缓存中没有的在一次线程池调用中一起查找'''
+    keys = [(mcversion, mapping.identity, mode, name, type_, namespace)
+            for name in names]
+    results = [RESULTS.get(key) for key in keys]
+    missing = [i for i, result in enumerate(results)
+               if result is ResultCache.MISSING]
+    if len(missing) > 0:
+        batch = [names[i] for i in missing]
+        if mode == 'find':
+            found = await run_query(mapping.find_many, batch, type_, namespace)
+        else:
+            found = [await run_query(
+                mapping.search if mode == 'search' else mapping.members,
+                batch[0], type_, namespace
+            )]
+        for i, result in zip(missing, found):
+            results[i] = result
+            RESULTS.put(keys[i], result)
+    return results
+
+
+async def setup_mapping(config: dict) -> None:
+    '''启动时按配置打开并预热常用版本，不阻塞事件循环'''
+    MAPPINGS.configure(config)
+    await asyncio.get_running_loop().run_in_executor(
+        EXECUTOR, MAPPINGS.warm_up, config.get('warm_up', [MCVERSION_MAX]))
 
 
 async def on_command_mapping(bot: Mirai, event: MessageEvent, args: list[str], _config: dict):
     if len(args) == 0:
         raise ArgumentException('参数不足')
-    name = args[0]
+    # 第一个参数总是名称，之后不是选项的参数也是名称
+    names = [args[0]]
+    mode = 'find'
     type_ = None
     namespace = None
     mcversion = MCVERSION_MAX
     for option in args[1:]:
-        if option in OPTIONS_TYPE:
+        if option in OPTIONS_MODE:
+            mode = option
+        elif option in OPTIONS_TYPE:
             type_ = option
         elif option in OPTIONS_NAMESPACE:
             namespace = option
         elif option in OPTIONS_MCVERSION:
             mcversion = option
         else:
-            raise ArgumentException('未知选项')
-    if mcversion not in MAPPINGS:
-        MAPPINGS[mcversion] = Mapping(mcversion)
+            names.append(option)
+    if len(names) > BATCH_LIMIT:
+        raise ArgumentException('名称过多')
+    if len(names) > 1 and mode != 'find':
+        raise ArgumentException(f'{mode} 只支持一个名称')
+    # 查询在线程池中进行，不阻塞事件循环
     try:
-        result = MAPPINGS[mcversion].find(name, type_, namespace)
+        if mode == 'trace':
+            result = await trace_mapping(names[0], type_, namespace, mcversion)
+        else:
+            mapping = await run_query(MAPPINGS.get, mcversion)
+            results = await lookup_mapping(
+                mapping, mcversion, mode, names, type_, namespace)
+            if len(names) == 1:
+                result = results[0]
+            else:
+                # 每个名称一条消息
+                result = [
+                    f'{name}\n未知映射' if result is None else '\n'.join(result)
+                    for name, result in zip(names, results)
+                ]
+    except (ArgumentException, BusyException):
+        raise
     except Exception:  # pylint: disable=broad-except
         print_exc()
         await bot.send(event, '内部错误')
@@ -203,30 +1055,512 @@ async def on_command_mapping(bot: Mirai, event: MessageEvent, args: list[str], _
 
 
 on_command_mapping.__doc__ = \
-    f'''!m [名称] [选项...]
-    查找并显示匹配的第一个映射
-    [选项] := [类型] | [命名空间] | [MC版本]
+    f'''!m [名称...] [选项...]
+    查找并显示匹配的第一个映射，一次最多查找 {BATCH_LIMIT} 个名称
+    [选项] := [模式] | [类型] | [命名空间] | [MC版本]
+    [模式] := search | trace | members [默认: 精确查找]
+    search: 模糊搜索并显示最接近的 {SEARCH_LIMIT} 个映射
+    trace: 显示在 [MC版本] 中找到的映射在所有版本中的名称
+    members: 列出类的字段与方法，可用 [类型] 只列出一种
     [类型] := class | field | method [默认: 任意]
     [命名空间] := official | intermediary | mojang | yarn [默认: 任意]
     [MC版本] := {MCVERSION_MIN} - {MCVERSION_MAX} [默认: {MCVERSION_MAX}]'''
 
 
+def parse_http_query(query: Any, default: dict[str, Any]) -> dict[str, Any]:
+    '''解析单个查询，可以是名称或包含 name、type、namespace、mcversion 的对象'''
+    if isinstance(query, str):
+        query = {'name': query}
+    if not isinstance(query, dict) or not isinstance(query.get('name'), str):
+        raise ArgumentException('名称无效')
+    query = {**default, **query}
+    if query['type'] is not None and query['type'] not in OPTIONS_TYPE:
+        raise ArgumentException('未知类型')
+    if (query['namespace'] is not None
+            and query['namespace'] not in OPTIONS_NAMESPACE):
+        raise ArgumentException('未知命名空间')
+    if query['mcversion'] not in OPTIONS_MCVERSION:
+        raise ArgumentException('未知的 mc 版本')
+    return query
+
+
+async def on_http_mapping(request: Request) -> JSONResponse:
+    '''POST /mapping
+
+    请求: {"names": [Name | {"name": Name, "type": ..., "namespace": ...,
+    "mcversion": ...}, ...], "type": ..., "namespace": ..., "mcversion": ...}
+    响应: {"results": [{"name": Name, "mcversion": ..., "yarn_version": ...,
+    "result": [Line, ...] | null}, ...]}
+
+    与 !m 共用连接池与结果缓存'''
+    try:
+        try:
+            body = await request.json()
+        except ValueError as exc:
+            raise ArgumentException('请求不是 JSON') from exc
+        if not isinstance(body, dict) or not isinstance(body.get('names'), list):
+            raise ArgumentException('缺少 names')
+        if len(body['names']) > HTTP_BATCH_LIMIT:
+            raise ArgumentException('名称过多')
+        default = {
+            'type': body.get('type'),
+            'namespace': body.get('namespace'),
+            'mcversion': body.get('mcversion', MCVERSION_MAX),
+        }
+        queries = [parse_http_query(query, default) for query in body['names']]
+        # 按版本与选项分组，每组在一次线程池调用中查找
+        groups: dict[tuple[str, Optional[str], Optional[str]], list[int]] = {}
+        for i, query in enumerate(queries):
+            groups.setdefault(
+                (query['mcversion'], query['type'], query['namespace']), []
+            ).append(i)
+        results: list[Optional[dict[str, Any]]] = [None] * len(queries)
+        for (mcversion, type_, namespace), group in groups.items():
+            mapping = await run_query(MAPPINGS.get, mcversion)
+            found = await lookup_mapping(
+                mapping, mcversion, 'find',
+                [queries[i]['name'] for i in group], type_, namespace)
+            for i, result in zip(group, found):
+                results[i] = {
+                    'name': queries[i]['name'],
+                    'mcversion': mcversion,
+                    'yarn_version': mapping.yarn_version,
+                    'result': result,
+                }
+    except ArgumentException as exc:
+        return JSONResponse({'error': str(exc)}, status_code=400)
+    except BusyException:
+        return JSONResponse({'error': '繁忙，请稍后再试'}, status_code=503)
+    except Exception:  # pylint: disable=broad-except
+        print_exc()
+        return JSONResponse({'error': '内部错误'}, status_code=500)
+    return JSONResponse({'results': results})
+
+
 def fetch_mapping() -> None:
-    version = argv[1]
-    print(f'Target version {version}')
-    print('Initializing database ...')
+    args = argv[1:]
+    offline = '--offline' in args
+    args = [arg for arg in args if arg != '--offline']
+    if len(args) == 0:
+        print('Usage: mapping [--offline] [update] <version>... | all\n'
+              '       mapping upgrade')
+        return
+    if sqlite_version_info < SEARCH_SQLITE_VERSION:
+        # 全文索引无法创建，提前退出而不是在生成每个版本时失败
+        raise SystemExit(
+            f'SQLite {".".join(map(str, SEARCH_SQLITE_VERSION))} or newer '
+            f'is required to build the search index, found '
+            f'{".".join(map(str, sqlite_version_info))}')
+    if args[0] == 'upgrade':
+        upgrade_mapping()
+        return
+    update = args[0] == 'update'
+    if update:
+        args = args[1:]
+    versions = list(OPTIONS_MCVERSION) if args == ['all'] else args
+    print(f'Target version {", ".join(versions)}')
     mapping_path = Path('mapping')
     if not mapping_path.exists():
         mapping_path.mkdir()
-    connection = init_database()
-    print('Mojang mapping')
-    fetch_mojang_mapping(version, connection)
-    print('Yarn mapping')
-    yarn_version = fetch_yarn_mapping(version, connection)
-    print('Writing database ...')
-    write_database(yarn_version, connection)
-    connection.commit()
+    failed = asyncio.run(fetch_mappings(versions, offline, update))
+    if len(failed) > 0:
+        # 在脚本或定时任务中以退出码区分失败
+        raise SystemExit(f'Failed version {", ".join(failed)}')
+    print('Done')
+
+
+async def fetch_mappings(
+    versions: list[str],
+    offline: bool = False,
+    update: bool = False
+) -> list[str]:
+    '''并发下载各版本的映射，并在进程池中解析与生成数据库，返回失败的版本'''
+    phases = Phases()
+    failed = []
+    async with httpx.AsyncClient(
+        headers=HEADERS,
+        limits=httpx.Limits(max_connections=MAX_CONNECTIONS)
+    ) as client:
+        cache = HTTPCache(client, CACHE_PATH, offline)
+        with phases('Fetching metadata'):
+            mojang_metadata, yarn_metadata = await asyncio.gather(
+                cache.get_json(MOJANG_METADATA_URL),
+                cache.get_json(YARN_METADATA_URL)
+            )
+        with ProcessPoolExecutor() as pool:
+            results = await asyncio.gather(*(
+                fetch_version(version, cache, pool,
+                              mojang_metadata, yarn_metadata, update)
+                for version in versions
+            ), return_exceptions=True)
+    for version, result in zip(versions, results):
+        if isinstance(result, BaseException):
+            print(f'[{version}] Failed: {result!r}')
+            failed.append(version)
+        else:
+            phases.timings.update(result)
+    phases.report()
+    print(f'Cache {cache.hit} hit, {cache.miss} miss')
+    return failed
+
+
+class HTTPCache:
+    '''保存响应及其 ETag 与 Last-Modified，之后以条件请求重新验证'''
+    client: httpx.AsyncClient
+    path: Path
+    offline: bool
+    hit: int
+    '''未修改或离线时直接使用缓存的次数'''
+    miss: int
+    '''下载完整响应的次数'''
+
+    def __init__(self, client: httpx.AsyncClient, path: Path,
+                 offline: bool = False) -> None:
+        self.client = client
+        self.path = path
+        self.offline = offline
+        self.hit = 0
+        self.miss = 0
+        if not self.path.exists():
+            self.path.mkdir(parents=True)
+
+    def entry(self, url: str) -> tuple[Path, Path]:
+        key = sha1(url.encode('utf8')).hexdigest()
+        return self.path / key, self.path / f'{key}.json'
+
+    async def fetch(self, url: str) -> Path:
+        '''返回缓存中与 url 对应的最新响应体'''
+        body_path, meta_path = self.entry(url)
+        cached = body_path.exists() and meta_path.exists()
+        if self.offline:
+            if not cached:
+                raise FileNotFoundError(f'{url} is not cached')
+            self.hit += 1
+            return body_path
+
+        headers = {}
+        if cached:
+            with open(meta_path, 'r', encoding='utf8') as f:
+                meta = json.load(f)
+            if meta.get('etag') is not None:
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified') is not None:
+                headers['If-Modified-Since'] = meta['last_modified']
+        try:
+            async with self.client.stream('GET', url, headers=headers) as r:
+                if r.status_code == 304 and cached:
+                    self.hit += 1
+                    return body_path
+                r.raise_for_status()
+                # 流式写入临时文件，完成后再替换，不在内存中保留完整的响应
+                temp_path = body_path.with_name(f'.{body_path.name}.tmp')
+                with open(temp_path, 'wb') as f:
+                    async for chunk in r.aiter_bytes():
+                        f.write(chunk)
+                os.replace(temp_path, body_path)
+                with open(meta_path, 'w', encoding='utf8') as f:
+                    json.dump({
+                        'url': url,
+                        'etag': r.headers.get('ETag'),
+                        'last_modified': r.headers.get('Last-Modified')
+                    }, f)
+        except httpx.TransportError as exc:
+            if not cached:
+                raise
+            print(f'Fetching {url} failed ({exc!r}), using cache')
+            self.hit += 1
+            return body_path
+        self.miss += 1
+        return body_path
+
+    async def get_json(self, url: str) -> Any:
+        with open(await self.fetch(url), 'r', encoding='utf8') as f:
+            return json.load(f)
+
+
+def read_lines(path: Path) -> Iterator[str]:
+    with open(path, 'rb') as f:
+        yield from iter_lines(iter(lambda: f.read(CHUNK_SIZE), b''))
+
+
+async def fetch_version(
+    version: str,
+    cache: HTTPCache,
+    pool: ProcessPoolExecutor,
+    mojang_metadata: Any,
+    yarn_metadata: Any,
+    update: bool = False
+) -> dict[str, float]:
+    phases = Phases(version)
+    for item in mojang_metadata['versions']:
+        if item['id'] == version:
+            url = item['url']
+            break
+    else:
+        raise ValueError('Unknown version')
+    builds = [item for item in yarn_metadata if item['gameVersion'] == version]
+    if len(builds) == 0:
+        raise ValueError('Yarn mapping not found')
+    yarn_version = max(builds, key=lambda item: item['build'])['version']
+    print(f'[{version}] Target yarn version {yarn_version}')
+
+    old_path = find_database(version) if update else None
+    if old_path is not None:
+        if old_path.name == f'{yarn_version}.db':
+            print(f'[{version}] Up to date')
+            return phases.timings
+        # 同一 mc 版本的 mojang 映射不会变化，只需比较新的 yarn 映射
+        with phases('Fetching mapping'):
+            yarn_path = await cache.fetch(
+                YARN_MAPPING_URL % ((yarn_version,) * 2))
+        timings = await asyncio.get_running_loop().run_in_executor(
+            pool, update_database, version, yarn_version, old_path, yarn_path)
+        phases.timings.update(timings)
+        return phases.timings
+
+    with phases('Fetching version metadata'):
+        downloads = (await cache.get_json(url))['downloads']
+
+    fetching = [cache.fetch(YARN_MAPPING_URL % ((yarn_version,) * 2))]
+    if 'client_mappings' in downloads:
+        fetching.append(cache.fetch(downloads['client_mappings']['url']))
+    else:
+        print(f'[{version}] Mojang mapping not found')
+    with phases('Fetching mapping'):
+        yarn_path, *mojang_path = await asyncio.gather(*fetching)
+
+    # 解析与生成数据库受 CPU 限制，放到进程池中进行
+    timings = await asyncio.get_running_loop().run_in_executor(
+        pool, build_database, version, yarn_version,
+        mojang_path[0] if len(mojang_path) > 0 else None, yarn_path)
+    phases.timings.update(timings)
+    return phases.timings
+
+
+def build_database(
+    version: str,
+    yarn_version: str,
+    mojang_path: Optional[Path],
+    yarn_path: Path
+) -> dict[str, float]:
+    phases = Phases(version)
+    data = MappingData()
+    if mojang_path is not None:
+        with phases('Parsing Mojang mapping'):
+            parse_mojang_mapping(read_lines(mojang_path), data)
+        with phases('Remapping method descriptor'):
+            remap_mojang_mapping(data)
+    with phases('Parsing Yarn mapping'):
+        parse_yarn_mapping(read_lines(yarn_path), data)
+    with phases('Initializing database'):
+        connection = init_database()
+    with phases('Inserting mapping'):
+        data.insert(connection)
+    write_database(yarn_version, connection, phases)
     connection.close()
+    return phases.timings
+
+
+def update_database(
+    version: str,
+    yarn_version: str,
+    old_path: Path,
+    yarn_path: Path
+) -> dict[str, float]:
+    phases = Phases(version)
+    data = MappingData()
+    with phases('Parsing Yarn mapping'):
+        parse_yarn_mapping(read_lines(yarn_path), data)
+    path = old_path.with_name(f'{yarn_version}.db')
+    temp_path = path.with_name(f'.{path.name}.tmp')
+    with phases('Copying database'):
+        copyfile(old_path, temp_path)
+    with phases('Applying changes'):
+        connection = connect(temp_path, isolation_level=None)
+        connection.execute('BEGIN;')
+        changed = data.apply_yarn(connection)
+    finalize_database(connection, phases)
+    with phases('Committing changes'):
+        connection.execute('COMMIT;')
+    with phases('Writing compact mapping'):
+        write_compact(connection, path.with_suffix('.bin'))
+        connection.close()
+    print(f'[{version}] {changed} rows changed')
+    # 替换后正在运行的 bot 会在下一次查询时打开新的数据库
+    os.replace(temp_path, path)
+    remove_stale_database(path)
+    return phases.timings
+
+
+class Phases:
+    '''按阶段输出进度并记录各阶段耗时'''
+    timings: dict[str, float]
+    '''{PhaseName: Second, ...}'''
+    section: Optional[str]
+
+    def __init__(self, section: Optional[str] = None) -> None:
+        self.timings = {}
+        self.section = section
+
+    @contextmanager
+    def __call__(self, name: str) -> Iterator[None]:
+        if self.section is None:
+            print(f'{name} ...', flush=True)
+            key = name
+        else:
+            print(f'[{self.section}] {name} ...', flush=True)
+            key = f'{self.section}: {name}'
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[key] = (self.timings.get(key, 0.0)
+                                 + perf_counter() - start)
+
+    def report(self) -> None:
+        print('Timings')
+        for key, second in self.timings.items():
+            print(f'  {key}: {second:.3f}s')
+
+
+TABLE_KEYS = {
+    'class': ('official',),
+    'field': ('official_class', 'official'),
+    'method': ('official_class', 'official', 'method_descriptor')
+}
+YARN_COLUMNS = {
+    'class': ('intermediary', 'yarn'),
+    'field': ('field_descriptor', 'intermediary', 'yarn'),
+    'method': ('intermediary', 'yarn')
+}
+
+
+class MappingData:
+    '''在内存中合并各来源的映射，以 official 名称为键'''
+    classes: dict[str, dict[str, str]]
+    '''{Official: {Column: Value, ...}, ...}'''
+    fields: dict[tuple[str, str], dict[str, str]]
+    '''{(OfficialClass, Official): {Column: Value, ...}, ...}'''
+    methods: dict[tuple[str, str, str], dict[str, str]]
+    '''{(OfficialClass, Official, MethodDescriptor): {Column: Value, ...}, ...}'''
+
+    def __init__(self) -> None:
+        self.classes = {}
+        self.fields = {}
+        self.methods = {}
+
+    def tables(self) -> dict[str, dict[tuple[str, ...], dict[str, str]]]:
+        return {
+            'class': {(k,): v for k, v in self.classes.items()},
+            'field': dict(self.fields),
+            'method': dict(self.methods)
+        }
+
+    def apply_yarn(self, c: Connection) -> int:
+        '''与数据库中已有的映射比较，只写入 yarn 映射有变化的行，返回变化的行数'''
+        changed = 0
+        for table, entries in self.tables().items():
+            keys = TABLE_KEYS[table]
+            columns = YARN_COLUMNS[table]
+            previous: dict[tuple[str, ...], tuple[tuple, Optional[str]]] = {}
+            for row in c.execute(
+                f'SELECT {", ".join(keys + columns)}, mojang FROM {table};'
+            ):
+                previous[tuple(row[:len(keys)])] = (
+                    tuple(row[len(keys):-1]), row[-1])
+            inserts = []
+            updates = []
+            deletes = []
+            for key, v in entries.items():
+                current = tuple(v.get(column) for column in columns)
+                if key not in previous:
+                    inserts.append(key + current)
+                elif previous[key][0] != current:
+                    updates.append(current + key)
+            for key, (values, mojang) in previous.items():
+                if key in entries or all(v is None for v in values):
+                    continue
+                if mojang is None:  # 只存在于旧的 yarn 映射中
+                    deletes.append(key)
+                else:
+                    updates.append((None,) * len(columns) + key)
+            where = (f'({", ".join(keys)}) = '
+                     f'({", ".join("?" * len(keys))})')
+            c.executemany(
+                f'INSERT INTO {table} ({", ".join(keys + columns)}) '
+                f'VALUES ({", ".join("?" * (len(keys) + len(columns)))});',
+                inserts
+            )
+            c.executemany(
+                f'UPDATE {table} SET '
+                f'{", ".join(column + " = ?" for column in columns)} '
+                f'WHERE {where};',
+                updates
+            )
+            c.executemany(f'DELETE FROM {table} WHERE {where};', deletes)
+            changed += len(inserts) + len(updates) + len(deletes)
+        return changed
+
+    def insert(self, c: Connection) -> None:
+        c.execute('BEGIN;')
+        c.executemany(
+            'INSERT INTO class (official, intermediary, mojang, yarn) '
+            'VALUES (?, ?, ?, ?);',
+            ((official, v.get('intermediary'), v.get('mojang'), v.get('yarn'))
+             for official, v in self.classes.items())
+        )
+        c.executemany(
+            'INSERT INTO field (official_class, official, field_descriptor, '
+            'intermediary, mojang, yarn) VALUES (?, ?, ?, ?, ?, ?);',
+            ((official_class, official, v.get('field_descriptor'),
+              v.get('intermediary'), v.get('mojang'), v.get('yarn'))
+             for (official_class, official), v in self.fields.items())
+        )
+        c.executemany(
+            'INSERT INTO method (official_class, official, method_descriptor, '
+            'intermediary, mojang, yarn) VALUES (?, ?, ?, ?, ?, ?);',
+            ((official_class, official, method_descriptor,
+              v.get('intermediary'), v.get('mojang'), v.get('yarn'))
+             for (official_class, official, method_descriptor), v
+             in self.methods.items())
+        )
+        c.execute('COMMIT;')
+
+
+def upgrade_mapping() -> None:
+    mapping_path = Path('mapping')
+    if not mapping_path.exists():
+        print('Mapping not found')
+        return
+    for f in sorted(next(os.walk(mapping_path))[2]):
+        if not f.endswith('.db'):
+            continue
+        print(f'Upgrading {f} ...')
+        connection = init_database()
+        connection.execute('ATTACH DATABASE ? AS old;',
+                           (str(mapping_path / f),))
+        connection.execute(
+            'INSERT OR IGNORE INTO class '
+            '(official, intermediary, mojang, yarn) '
+            'SELECT official, intermediary, mojang, yarn FROM old.class;'
+        )
+        connection.execute(
+            'INSERT OR IGNORE INTO field '
+            '(official_class, official, field_descriptor, '
+            'intermediary, mojang, yarn) '
+            'SELECT official_class, official, field_descriptor, '
+            'intermediary, mojang, yarn FROM old.field;'
+        )
+        connection.execute(
+            'INSERT OR IGNORE INTO method '
+            '(official_class, official, method_descriptor, '
+            'intermediary, mojang, yarn) '
+            'SELECT official_class, official, method_descriptor, '
+            'intermediary, mojang, yarn FROM old.method;'
+        )
+        connection.execute('DETACH DATABASE old;')
+        write_database(f.rsplit('.', 1)[0], connection)
+        connection.close()
     print('Done')
 
 
@@ -236,7 +1570,11 @@ def init_database() -> Connection:
         official TEXT PRIMARY KEY NOT NULL,
         intermediary TEXT,
         mojang TEXT,
-        yarn TEXT
+        yarn TEXT,
+        official_short TEXT,
+        intermediary_short TEXT,
+        mojang_short TEXT,
+        yarn_short TEXT
     );''')
     c.execute('''CREATE TABLE field (
         official_class TEXT NOT NULL,
@@ -254,27 +1592,127 @@ def init_database() -> Connection:
         intermediary TEXT,
         mojang TEXT,
         yarn TEXT,
+        mojang_signature TEXT,
+        mojang_mixin TEXT,
+        yarn_signature TEXT,
+        yarn_mixin TEXT,
         PRIMARY KEY (official_class, official, method_descriptor)
     );''')
     return c
 
 
-def insert_or_update(
-    table: str,
-    primary_key: dict[str, str],
-    other: dict[str, str],
-    c: Connection
-) -> None:
+def short_name(name: Optional[str]) -> Optional[str]:
+    if name is None:
+        return None
+    return name.rsplit('.', 1)[-1]
+
+
+def create_short_name(c: Connection) -> None:
+    c.create_function('short_name', 1, short_name, deterministic=True)
+    c.execute('UPDATE class SET ' + ', '.join(
+        f'{ns}_short = short_name({ns})' for ns in OPTIONS_NAMESPACE
+    ) + ' WHERE ' + ' OR '.join(
+        f'{ns}_short IS NOT short_name({ns})' for ns in OPTIONS_NAMESPACE
+    ) + ';')
+
+
+def create_signature(c: Connection) -> None:
+    # 签名与 mixin 只取决于描述符与类名，生成数据库时一次算好
+    names: dict[str, dict[str, str]] = {'mojang': {}, 'yarn': {}}
+    for official, mojang, yarn in c.execute(
+        'SELECT official, mojang, yarn FROM class;'
+    ):
+        if mojang is not None:
+            names['mojang'][official] = mojang
+        if yarn is not None:
+            names['yarn'][official] = yarn
+    rows = []
+    for rowid, descriptor, *previous in c.execute(
+        'SELECT rowid, method_descriptor, mojang_signature, mojang_mixin, '
+        'yarn_signature, yarn_mixin FROM method;'
+    ).fetchall():
+        method = parse_method_descriptor(descriptor)
+        if method is None:
+            current = [descriptor] * 4
+        else:
+            current = [
+                render_method(method, names['mojang']),
+                render_mixin(method, names['mojang']),
+                render_method(method, names['yarn']),
+                render_mixin(method, names['yarn'])
+            ]
+        if current != previous:
+            rows.append((*current, rowid))
+    c.executemany(
+        'UPDATE method SET mojang_signature = ?, mojang_mixin = ?, '
+        'yarn_signature = ?, yarn_mixin = ? WHERE rowid = ?;',
+        rows
+    )
+
+
+def finalize_database(c: Connection, phases: Phases) -> None:
+    '''生成由基本列推导出的列与索引，只写入有变化的行'''
+    with phases('Generating short names'):
+        create_short_name(c)
+    with phases('Generating signatures'):
+        create_signature(c)
+    with phases('Building search index'):
+        create_search(c)
+    with phases('Building indexes'):
+        create_index(c)
+
+
+def create_search(c: Connection) -> None:
+    '''创建所有命名空间的三元组全文索引，之后由触发器保持同步
+
+    全文索引的 rowid 为 原表 rowid * 3 + 类型序号'''
+    if c.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'search';"
+    ).fetchone() is not None:
+        return
     c.execute(
-        f'INSERT OR IGNORE INTO {table} ({", ".join(primary_key.keys())}) '
-        f'VALUES ({", ".join("?" * len(primary_key))});',
-        list(primary_key.values())
+        f'CREATE VIRTUAL TABLE search USING fts5('
+        f'{", ".join(OPTIONS_NAMESPACE)}, content=\'\', tokenize=\'trigram\');'
     )
-    if len(other) > 0:
+    for i, table in enumerate(OPTIONS_TYPE):
+        # 类只索引名称的最后一段
+        columns = [f'{ns}_short' if table == 'class' else ns
+                   for ns in OPTIONS_NAMESPACE]
+        insert = (
+            f'INSERT INTO search (rowid, {", ".join(OPTIONS_NAMESPACE)}) '
+            f'VALUES (new.rowid * 3 + {i}, '
+            f'{", ".join("new." + column for column in columns)});'
+        )
+        delete = (
+            f'INSERT INTO search (search, rowid, {", ".join(OPTIONS_NAMESPACE)}) '
+            f'VALUES (\'delete\', old.rowid * 3 + {i}, '
+            f'{", ".join("old." + column for column in columns)});'
+        )
         c.execute(
-            f'UPDATE {table} SET {", ".join(s + " = ?" for s in other.keys())} '
-            f'WHERE ({", ".join(primary_key.keys())}) = ({", ".join("?" * len(primary_key))});',
-            (*other.values(), *primary_key.values())
+            f'INSERT INTO search (rowid, {", ".join(OPTIONS_NAMESPACE)}) '
+            f'SELECT rowid * 3 + {i}, {", ".join(columns)} FROM {table};'
+        )
+        c.execute(f'CREATE TRIGGER {table}_search_insert AFTER INSERT '
+                  f'ON {table} BEGIN {insert} END;')
+        c.execute(f'CREATE TRIGGER {table}_search_delete AFTER DELETE '
+                  f'ON {table} BEGIN {delete} END;')
+        c.execute(f'CREATE TRIGGER {table}_search_update AFTER UPDATE '
+                  f'OF {", ".join(columns)} ON {table} '
+                  f'BEGIN {delete} {insert} END;')
+
+
+def create_index(c: Connection) -> None:
+    # 所有命名空间都按 COLLATE NOCASE 查询，索引也须使用相同的排序规则
+    for table in OPTIONS_TYPE:
+        for namespace in OPTIONS_NAMESPACE:
+            c.execute(
+                f'CREATE INDEX IF NOT EXISTS {table}_{namespace} '
+                f'ON {table} ({namespace} COLLATE NOCASE);'
+            )
+    for namespace in OPTIONS_NAMESPACE:
+        c.execute(
+            f'CREATE INDEX IF NOT EXISTS class_{namespace}_short '
+            f'ON class ({namespace}_short COLLATE NOCASE);'
         )
 
 
@@ -291,29 +1729,26 @@ FIELD_DESCRIPTORS = {
 }
 
 
-def remap_field_mojang(field: str, c: Connection) -> str:
+def remap_field_mojang(field: str, classes: dict[str, str]) -> str:
     array_dimension_count = 0
     while field.endswith('[]'):
         field = field[:-2]
         array_dimension_count += 1
     if field in FIELD_DESCRIPTORS:
         return '[' * array_dimension_count + FIELD_DESCRIPTORS[field]
-    for row in c.execute('SELECT official FROM class WHERE mojang = ?;', (field,)):
-        field = row[0]
-        break
-    field = field.replace('.', '/')
+    field = classes.get(field, field).replace('.', '/')
     return f'{"[" * array_dimension_count}L{field};'
 
 
-def remap_method_mojang(method: str, c: Connection) -> Optional[str]:
-    m = re_match(r'\(([\w$.[\],]*)\)([\w$.[\]]+)', method)
+def remap_method_mojang(method: str, classes: dict[str, str]) -> Optional[str]:
+    m = MOJANG_DESCRIPTOR_RE.match(method)
     if m is None:
         return None
     args, retval = m.groups()
     args = args.split(',')
-    args = ''.join(remap_field_mojang(arg, c)
+    args = ''.join(remap_field_mojang(arg, classes)
                    for arg in args if len(arg) > 0)
-    retval = remap_field_mojang(retval, c)
+    retval = remap_field_mojang(retval, classes)
     return f'({args}){retval}'
 
 
@@ -329,279 +1764,338 @@ FIELD_TYPES = {
     'V': 'void'
 }
 
-
-def map_field_mojang(field: str, c: Connection) -> str:
-    array_dimension_count = 0
-    while field.startswith('['):
-        field = field[1:]
-        array_dimension_count += 1
-    if field in FIELD_TYPES:
-        return FIELD_TYPES[field] + '[]' * array_dimension_count
-    if field.startswith('L') and field.endswith(';'):
-        field = field[1:-1]
-    field = field.replace('/', '.')
-    for row in c.execute('SELECT mojang FROM class WHERE official = ?;', (field,)):
-        field = row[0]
-        break
-    return field + '[]' * array_dimension_count
-
-
-def map_field_yarn(field: str, c: Connection) -> str:
-    array_dimension_count = 0
-    while field.startswith('['):
-        field = field[1:]
-        array_dimension_count += 1
-    if field in FIELD_TYPES:
-        return FIELD_TYPES[field] + '[]' * array_dimension_count
-    if field.startswith('L') and field.endswith(';'):
-        field = field[1:-1]
-    field = field.replace('/', '.')
-    for row in c.execute('SELECT yarn FROM class WHERE official = ?;', (field,)):
-        field = row[0]
-        break
-    return field + '[]' * array_dimension_count
-
-
-def map_method_mojang(method: str, c: Connection) -> Optional[str]:
-    m = re_match(r'\(([\w$/[;]*)\)([\w$./[;]+)', method)
-    if m is None:
+FieldType = tuple[int, str]
+'''(数组维数, 基本类型名或以 . 分隔的 official 类名)'''
+MethodType = tuple[list[FieldType], FieldType]
+'''([参数类型, ...], 返回值类型)'''
+
+
+def parse_field_descriptor(
+    descriptor: str,
+    start: int = 0
+) -> Optional[tuple[FieldType, int]]:
+    '''从 start 处解析一个字段描述符，返回类型与结束位置'''
+    i = start
+    while i < len(descriptor) and descriptor[i] == '[':
+        i += 1
+    if i >= len(descriptor):
         return None
-    args, retval = m.groups()
-    buffer = ''
-    object_flag = False
-    args_list = []
-    while len(args) > 0:
-        buffer += args[0]
-        if object_flag:
-            if args[0] == ';':
-                args_list.append(map_field_mojang(buffer, c))
-                buffer = ''
-                object_flag = False
-        else:
-            if args[0] in FIELD_TYPES:
-                args_list.append(map_field_mojang(buffer, c))
-                buffer = ''
-            elif args[0] == 'L':
-                object_flag = True
-        args = args[1:]
-    retval = map_field_mojang(retval, c)
-    return f'({", ".join(args_list)}) -> {retval}'
+    if descriptor[i] in FIELD_TYPES:
+        return (i - start, FIELD_TYPES[descriptor[i]]), i + 1
+    if descriptor[i] == 'L':
+        end = descriptor.find(';', i)
+        if end < 0:
+            return None
+        return (i - start, descriptor[i + 1:end].replace('/', '.')), end + 1
+    return None
 
 
-def map_method_yarn(method: str, c: Connection) -> Optional[str]:
-    m = re_match(r'\(([\w$/[;]*)\)([\w$./[;]+)', method)
-    if m is None:
+def parse_method_descriptor(descriptor: str) -> Optional[MethodType]:
+    if not descriptor.startswith('('):
         return None
-    args, retval = m.groups()
-    buffer = ''
-    object_flag = False
-    args_list = []
-    while len(args) > 0:
-        buffer += args[0]
-        if object_flag:
-            if args[0] == ';':
-                args_list.append(map_field_yarn(buffer, c))
-                buffer = ''
-                object_flag = False
-        else:
-            if args[0] in FIELD_TYPES:
-                args_list.append(map_field_yarn(buffer, c))
-                buffer = ''
-            elif args[0] == 'L':
-                object_flag = True
-        args = args[1:]
-    retval = map_field_yarn(retval, c)
-    return f'({", ".join(args_list)}) -> {retval}'
-
-
-def map_mixin_mojang(descriptor: str, c: Connection) -> str:
-    buffer = ''
-    object_flag = False
-    map_mixin = ''
-    while len(descriptor) > 0:
-        buffer += descriptor[0]
-        if object_flag:
-            if descriptor[0] == ';':
-                s = buffer[:-1]
-                for row in c.execute('SELECT mojang FROM class WHERE official = ?;', (s,)):
-                    s = row[0]
-                    break
-                s = s.replace('.', '/')
-                map_mixin += s + ';'
-                buffer = ''
-                object_flag = False
-        else:
-            if descriptor[0] == 'L':
-                map_mixin += buffer
-                buffer = ''
-                object_flag = True
-        descriptor = descriptor[1:]
-    map_mixin += buffer
-    return map_mixin
-
-
-def map_mixin_yarn(descriptor: str, c: Connection) -> str:
-    buffer = ''
-    object_flag = False
-    map_mixin = ''
-    while len(descriptor) > 0:
-        buffer += descriptor[0]
-        if object_flag:
-            if descriptor[0] == ';':
-                s = buffer[:-1]
-                for row in c.execute('SELECT yarn FROM class WHERE official = ?;', (s,)):
-                    s = row[0]
-                    break
-                s = s.replace('.', '/')
-                map_mixin += s + ';'
-                buffer = ''
-                object_flag = False
-        else:
-            if descriptor[0] == 'L':
-                map_mixin += buffer
-                buffer = ''
-                object_flag = True
-        descriptor = descriptor[1:]
-    map_mixin += buffer
-    return map_mixin
-
-
-def fetch_mojang_mapping(version: str, c: Connection) -> None:
-    print('  Fetching metadata ...')
-    r = CLIENT.get(MOJANG_METADATA_URL)
-
-    print('  Parsing metadata ...')
-    for item in r.json()['versions']:
-        if item['id'] == version:
-            url = item['url']
-            break
-
-    print('  Fetching version metadata ...')
-    r = CLIENT.get(url)
-
-    print('  Parsing version metadata ...')
-    downloads = r.json()['downloads']
-    if 'client_mappings' not in downloads:
-        print('  Mapping not found')
-        return
+    args = []
+    i = 1
+    while i < len(descriptor) and descriptor[i] != ')':
+        parsed = parse_field_descriptor(descriptor, i)
+        if parsed is None:
+            return None
+        arg, i = parsed
+        args.append(arg)
+    parsed = parse_field_descriptor(descriptor, i + 1)
+    if parsed is None or parsed[1] != len(descriptor):
+        return None
+    return args, parsed[0]
+
+
+def render_field(field: FieldType, names: dict[str, str]) -> str:
+    dimension, name = field
+    return names.get(name, name) + '[]' * dimension
+
+
+def render_field_descriptor(field: FieldType, names: dict[str, str]) -> str:
+    dimension, name = field
+    if name in FIELD_DESCRIPTORS:
+        return '[' * dimension + FIELD_DESCRIPTORS[name]
+    name = names.get(name, name).replace('.', '/')
+    return f'{"[" * dimension}L{name};'
+
+
+def render_method(method: MethodType, names: dict[str, str]) -> str:
+    args, retval = method
+    return (f'({", ".join(render_field(arg, names) for arg in args)})'
+            f' -> {render_field(retval, names)}')
+
+
+def render_mixin(method: MethodType, names: dict[str, str]) -> str:
+    args, retval = method
+    return (f'({"".join(render_field_descriptor(arg, names) for arg in args)})'
+            f'{render_field_descriptor(retval, names)}')
+
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def iter_lines(chunks: Iterable[bytes]) -> Iterator[str]:
+    '''逐块解压（若为 gzip）、解码并切分为行'''
+    decompressor = None
+    decoder = getincrementaldecoder('utf8')()
+    pending = ''
+    head: Optional[bytes] = b''  # 读到足够判断是否为 gzip 的字节前暂存
+    for chunk in chunks:
+        if head is not None:
+            head += chunk
+            if len(head) < len(GZIP_MAGIC):
+                continue
+            if head.startswith(GZIP_MAGIC):
+                decompressor = decompressobj(16 + MAX_WBITS)
+            chunk, head = head, None
+        if decompressor is not None:
+            chunk = decompressor.decompress(chunk)
+        lines = (pending + decoder.decode(chunk)).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line.rstrip('\r')
+    rest = head or b''
+    if decompressor is not None:
+        rest = decompressor.flush()
+    for line in (pending + decoder.decode(rest, final=True)).split('\n'):
+        if line != '':
+            yield line.rstrip('\r')
+
+
+MOJANG_CLASS_RE = re_compile(r'([\w$.-]+)\s+->\s+([\w$.]+):')
+MOJANG_FIELD_RE = re_compile(r'\s+[\w$.[\]]+\s+([\w$]+)\s+->\s+([\w$]+)')
+MOJANG_METHOD_RE = re_compile(
+    r'\s+(?:\d+:\d+:)?([\w$.[\]]+)\s+([\w$<>]+)(\([\w$.[\],]*\))\s+->\s+([\w<>$]+)'
+)
+MOJANG_DESCRIPTOR_RE = re_compile(r'\(([\w$.[\],]*)\)([\w$.[\]]+)')
 
-    print('  Fetching mapping ...')
-    url = downloads['client_mappings']['url']
-    r = CLIENT.get(url)
 
-    print('  Parsing mapping ...')
-    for l in r.text.splitlines(False):
+def parse_mojang_mapping(lines: Iterable[str], data: MappingData) -> None:
+    for l in lines:
         if l.startswith('#'):
             continue
-        m = re_match(r'([\w$.-]+)\s+->\s+([\w$.]+):', l)
+        m = MOJANG_CLASS_RE.match(l)
         if m is not None:  # matches a class
             mapping_class = m[2]
-            insert_or_update('class', {
-                'official': m[2]
-            }, {
-                'mojang': m[1]
-            }, c)
+            data.classes.setdefault(m[2], {})['mojang'] = m[1]
             continue
-        m = re_match(r'\s+[\w$.[\]]+\s+([\w$]+)\s+->\s+([\w$]+)', l)
+        m = MOJANG_FIELD_RE.match(l)
         if m is not None:  # matches a field
-            insert_or_update('field', {
-                'official': m[2],
-                'official_class': mapping_class
-            }, {
-                'mojang': m[1]
-            }, c)
+            data.fields.setdefault(
+                (mapping_class, m[2]), {})['mojang'] = m[1]
             continue
-        m = re_match(
-            r'\s+(?:\d+:\d+:)?([\w$.[\]]+)\s+([\w$<>]+)(\([\w$.[\],]*\))\s+->\s+([\w<>$]+)', l
-        )
+        m = MOJANG_METHOD_RE.match(l)
         if m is not None:  # matches a method
-            insert_or_update('method', {
-                'method_descriptor': m[3] + m[1],
-                'official': m[4],
-                'official_class': mapping_class
-            }, {
-                'mojang': m[2]
-            }, c)
+            data.methods.setdefault(
+                (mapping_class, m[4], m[3] + m[1]), {})['mojang'] = m[2]
             continue
         print(f'Parsing "{l}" failed!')
 
-    print('  Remapping method descriptor ...')
-    for row in c.execute(
-        'SELECT official_class, official, method_descriptor FROM method;'
-    ).fetchall():
-        method_descriptor = remap_method_mojang(row[2], c)
-        if method_descriptor is None:
-            print(f'Remapping "{row[2]}" failed!')
-            continue
-        c.execute(
-            'UPDATE method SET method_descriptor = ? WHERE '
-            '(official_class, official, method_descriptor) = (?, ?, ?);',
-            (method_descriptor, row[0], row[1], row[2])
-        )
 
-
-def fetch_yarn_mapping(version: str, c: Connection) -> str:
-    print('  Fetching metadata ...')
-    r = CLIENT.get(YARN_METADATA_URL)
-
-    print('  Parsing metadata ...')
-    latest_build = 0
-    latest_version = ''
-    for item in r.json():
-        if item['gameVersion'] == version:
-            if latest_build < item['build']:
-                latest_version = item['version']
-            break
-
-    print(f'  Target version {latest_version} ...')
-    print('  Fetching mapping ...')
-    url = YARN_MAPPING_URL % ((latest_version,) * 2)
-    r = CLIENT.get(url)
-
-    print('  Parsing mapping ...')
-    for l in decompress(r.content).decode('utf8').splitlines(False)[1:]:
+def remap_mojang_mapping(data: MappingData) -> None:
+    '''将方法描述符从 mojang 名称转换为 official 名称'''
+    classes = {v['mojang']: official for official, v in data.classes.items()
+               if 'mojang' in v}
+    methods: dict[tuple[str, str, str], dict[str, str]] = {}
+    for (official_class, official, method_descriptor), v in data.methods.items():
+        remapped = remap_method_mojang(method_descriptor, classes)
+        if remapped is None:
+            print(f'Remapping "{method_descriptor}" failed!')
+            remapped = method_descriptor
+        methods.setdefault((official_class, official, remapped), {}).update(v)
+    data.methods = methods
+
+
+def parse_yarn_mapping(lines: Iterable[str], data: MappingData) -> None:
+    lines = iter(lines)
+    next(lines, None)  # skips the header
+    for l in lines:
         type_, *items = l.split()
         if type_ == 'CLASS':
-            insert_or_update('class', {
-                'official': items[0].replace('/', '.')
-            }, {
-                'intermediary': items[1].replace('/', '.'),
-                'yarn': items[2].replace('/', '.')
-            }, c)
+            data.classes.setdefault(items[0].replace('/', '.'), {}).update(
+                intermediary=items[1].replace('/', '.'),
+                yarn=items[2].replace('/', '.')
+            )
             continue
         elif type_ == 'FIELD':
-            insert_or_update('field', {
-                'official_class': items[0].replace('/', '.'),
-                'official': items[2].replace('/', '.')
-            }, {
-                'field_descriptor': items[1],
-                'intermediary': items[3].replace('/', '.'),
-                'yarn': items[4].replace('/', '.')
-            }, c)
+            data.fields.setdefault((
+                items[0].replace('/', '.'),
+                items[2].replace('/', '.')
+            ), {}).update(
+                field_descriptor=items[1],
+                intermediary=items[3].replace('/', '.'),
+                yarn=items[4].replace('/', '.')
+            )
             continue
         elif type_ == 'METHOD':
-            insert_or_update('method', {
-                'official_class': items[0].replace('/', '.'),
-                'method_descriptor': items[1],
-                'official': items[2].replace('/', '.')
-            }, {
-                'intermediary': items[3].replace('/', '.'),
-                'yarn': items[4].replace('/', '.')
-            }, c)
+            data.methods.setdefault((
+                items[0].replace('/', '.'),
+                items[2].replace('/', '.'),
+                items[1]
+            ), {}).update(
+                intermediary=items[3].replace('/', '.'),
+                yarn=items[4].replace('/', '.')
+            )
             continue
         print(f'Parsing "{l}" failed!')
 
-    return latest_version
-
 
-def write_database(version: str, c: Connection):
+def write_database(
+    version: str,
+    c: Connection,
+    phases: Optional[Phases] = None
+) -> None:
+    if phases is None:
+        phases = Phases(version)
     path = Path('mapping') / f'{version}.db'
-    if path.exists():
-        os.remove(path)
-    c.execute('ATTACH DATABASE ? AS disk;', (str(path),))
-    c.execute('CREATE TABLE disk.class AS SELECT * FROM class;')
-    c.execute('CREATE TABLE disk.field AS SELECT * FROM field;')
-    c.execute('CREATE TABLE disk.method AS SELECT * FROM method;')
+    # 先写入临时文件再替换，读取方不会看到写了一半的数据库
+    temp_path = path.with_name(f'.{path.name}.tmp')
+    if temp_path.exists():
+        os.remove(temp_path)
+    finalize_database(c, phases)
+    # 使用 backup 复制整个数据库，以保留主键与索引
+    with phases('Writing database'):
+        disk = connect(temp_path)
+        c.backup(disk)
+        disk.close()
+    # 紧凑映射文件先于数据库就位，bot 打开新数据库时即可使用
+    with phases('Writing compact mapping'):
+        write_compact(c, path.with_suffix('.bin'))
+    os.replace(temp_path, path)
+    remove_stale_database(path)
+
+
+class StringTable(dict):
+    '''{String: StringIndex, ...}，新字符串按出现顺序编号，None 为 COMPACT_NULL'''
+
+    def __init__(self) -> None:
+        super().__init__({None: COMPACT_NULL})
+
+    def __missing__(self, string: str) -> int:
+        ref = self[string] = len(self) - 1
+        return ref
+
+
+def fold_name(name: str) -> str:
+    '''与 NOCASE 相同只将 ASCII 转为小写'''
+    if name.isascii():
+        return name.lower()
+    return name.encode('utf-8').lower().decode('utf-8')
+
+
+def write_compact(c: Connection, path: Path) -> None:
+    '''将数据库导出为紧凑映射文件，格式见 CompactMapping'''
+    strings = StringTable()
+    sections: dict[str, Any] = {}
+    rows: dict[str, list[tuple]] = {}
+    class_ids: dict[str, int] = {}
+    for t in OPTIONS_TYPE:
+        columns = COMPACT_COLUMNS[t]
+        rows[t] = c.execute(
+            f'SELECT {", ".join(col for col in columns if col != "class_id")} '
+            f'FROM {t} ORDER BY rowid;'
+        ).fetchall()
+        records = array('I')
+        for i, row in enumerate(rows[t]):
+            if t == 'class':
+                class_ids[row[0]] = i
+            else:
+                records.append(class_ids.get(row[0], COMPACT_NULL))
+            records.extend(map(strings.__getitem__, row))
+        sections[t] = records
+    # (Key, FullName, RecordIndex)，每个 COMPACT_KEYS 一组
+    entries: list[list[tuple[str, str, int]]] = []
+    for t, column in COMPACT_KEYS:
+        position = COMPACT_COLUMNS[t].index(column)
+        if t != 'class':
+            position -= 1
+        if column.endswith('_short'):
+            full = COMPACT_COLUMNS[t].index(column[:-len('_short')])
+        else:
+            full = position
+        entries.append([
+            (row[position], row[full], i) for i, row in enumerate(rows[t])
+            if row[position] is not None
+            and (t == 'class' or row[0] in class_ids)
+        ])
+    # 字符串按码位排序与 UTF-8 字节序相同，先排序去重后的字符串，
+    # 再将排序依据合成一个整数排序所有键，比逐个比较元组快
+    names = sorted({name for group in entries for key, full, _ in group
+                    for name in (key, full)})
+    full_rank = {name: rank for rank, name in enumerate(names)}
+    folded_names = {name: fold_name(name) for name in names}
+    folded = sorted(set(folded_names.values()))
+    folded_rank = {name: rank for rank, name in enumerate(folded)}
+    key_rank = {name: folded_rank[folded_names[name]] for name in names}
+    # 与 resolve_sql 相同：完整名称相同时按序号，最后一段相同时按完整名称
+    record_count = max(len(r) for r in rows.values()) + 1
+    packed = []
+    for key_index, group in enumerate(entries):
+        packed.extend(
+            ((key_rank[key] * len(COMPACT_KEYS) + key_index) * len(names)
+             + full_rank[full]) * record_count + i
+            for key, full, i in group
+        )
+    packed.sort()
+    keys = array('I')
+    groups = array('I')
+    previous = -1
+    for position, value in enumerate(packed):
+        rest, i = divmod(value, record_count)
+        rank, key_index = divmod(rest // len(names), len(COMPACT_KEYS))
+        if rank != previous:
+            groups.append(position)
+            previous = rank
+        keys.extend((key_index, i))
+    groups.append(len(packed))
+    sections['keys'] = keys
+    sections['groups'] = groups
+    encoded_folded = [name.encode('utf-8') for name in folded]
+    folded_offsets = array('I', [0])
+    for key in encoded_folded:
+        folded_offsets.append(folded_offsets[-1] + len(key))
+    sections['folded_offsets'] = folded_offsets
+    sections['folded'] = b''.join(encoded_folded)
+    encoded = [string.encode('utf-8') for string in strings if string is not None]
+    offsets = array('I', [0])
+    for string in encoded:
+        offsets.append(offsets[-1] + len(string))
+    sections['offsets'] = offsets
+    sections['strings'] = b''.join(encoded)
+
+    header = array('I')
+    blobs = []
+    offset = len(COMPACT_MAGIC) + 8 * len(COMPACT_SECTIONS)
+    for name in COMPACT_SECTIONS:
+        section = sections[name]
+        if isinstance(section, array):
+            if byteorder == 'big':
+                section.byteswap()
+            section = section.tobytes()
+        header.extend((offset, len(section)))
+        # 按 4 字节对齐
+        section += b'\x00' * (-len(section) % 4)
+        blobs.append(section)
+        offset += len(section)
+    if byteorder == 'big':
+        header.byteswap()
+    temp_path = path.with_name(f'.{path.name}.tmp')
+    with open(temp_path, 'wb') as f:
+        f.write(COMPACT_MAGIC)
+        f.write(header.tobytes())
+        for blob in blobs:
+            f.write(blob)
+    os.replace(temp_path, path)
+
+
+def remove_stale_database(path: Path) -> None:
+    '''删除同一 mc 版本的其他 yarn 版本的数据库与紧凑映射文件'''
+    prefix = path.name.split('+', 1)[0] + '+'
+    for f in next(os.walk(path.parent))[2]:
+        if (f.startswith(prefix) and f.endswith(('.db', '.bin'))
+                and f.rsplit('.', 1)[0] != path.stem):
+            os.remove(path.parent / f)
 
 
 if __name__ == '__main__':
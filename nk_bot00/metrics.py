@@ -0,0 +1,214 @@
+import asyncio
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import monotonic, perf_counter
+from typing import Callable, Iterator, Optional
+
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0)
+'''延迟直方图的上界（秒），与默认超时 30 秒对应'''
+LOOP_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                    1.0, 5.0)
+LOOP_LAG_INTERVAL = 0.5
+'''测量事件循环延迟的间隔（秒）'''
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+Labels = tuple[str, ...]
+Collector = Callable[[], dict[Labels, float]]
+
+
+def escape(value: str) -> str:
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def render_labels(names: Labels, values: Labels, extra: str = '') -> str:
+    pairs = [f'{k}="{escape(v)}"' for k, v in zip(names, values)]
+    if extra != '':
+        pairs.append(extra)
+    if len(pairs) == 0:
+        return ''
+    return '{' + ','.join(pairs) + '}'
+
+
+def render_number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+class Metric:
+    '''Prometheus 文本格式的一项指标'''
+    type_ = 'untyped'
+
+    def __init__(self, name: str, help_: str, labels: Labels = (),
+                 collect: Optional[Collector] = None) -> None:
+        self.name = name
+        self.help = help_
+        self.labels = labels
+        self.values: dict[Labels, float] = {}
+        '''{(LabelValue, ...): Value, ...}'''
+        self.collect = collect
+        '''导出时读取其他模块状态的函数，代替主动记录'''
+
+    def samples(self) -> Iterator[str]:
+        values = self.values if self.collect is None else self.collect()
+        for labels, value in sorted(values.items()):
+            yield (f'{self.name}{render_labels(self.labels, labels)}'
+                   f' {render_number(value)}')
+
+    def render(self) -> str:
+        return '\n'.join((
+            f'# HELP {self.name} {self.help}',
+            f'# TYPE {self.name} {self.type_}',
+            *self.samples()
+        ))
+
+
+class Counter(Metric):
+    type_ = 'counter'
+
+    def inc(self, labels: Labels = (), value: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + value
+
+
+class Gauge(Metric):
+    type_ = 'gauge'
+
+    def set(self, value: float, labels: Labels = ()) -> None:
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    type_ = 'histogram'
+
+    def __init__(self, name: str, help_: str, labels: Labels = (),
+                 buckets: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        super().__init__(name, help_, labels)
+        self.buckets = buckets
+        self.counts: dict[Labels, list[int]] = {}
+        '''{(LabelValue, ...): [BucketCount, ..., InfCount], ...}，不累加'''
+        self.sums: dict[Labels, float] = {}
+
+    def observe(self, value: float, labels: Labels = ()) -> None:
+        if labels not in self.counts:
+            self.counts[labels] = [0] * (len(self.buckets) + 1)
+            self.sums[labels] = 0.0
+        # 记录时只增加一个桶，导出时再累加
+        self.counts[labels][bisect_left(self.buckets, value)] += 1
+        self.sums[labels] += value
+
+    @contextmanager
+    def time(self, labels: Labels = ()) -> Iterator[None]:
+        '''记录代码块的耗时，包括抛出异常的情况'''
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, labels)
+
+    def samples(self) -> Iterator[str]:
+        for labels, counts in sorted(self.counts.items()):
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                le = f'le="{render_number(bound)}"'
+                yield (f'{self.name}_bucket'
+                       f'{render_labels(self.labels, labels, le)} {total}')
+            rendered = render_labels(self.labels, labels)
+            yield f'{self.name}_sum{rendered} {render_number(self.sums[labels])}'
+            yield f'{self.name}_count{rendered} {total}'
+
+
+class MetricsRegistry:
+    '''进程内的全部指标，只在事件循环中记录与导出，不需要加锁'''
+
+    def __init__(self) -> None:
+        self.metrics: dict[str, Metric] = {}
+        '''{Name: Metric, ...}'''
+
+    def register(self, metric: Metric) -> Metric:
+        # 重新注册同名指标时替换，重新加载配置时不会重复
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help_: str, labels: Labels = (),
+                collect: Optional[Collector] = None) -> Counter:
+        metric = Counter(name, help_, labels, collect)
+        self.register(metric)
+        return metric
+
+    def gauge(self, name: str, help_: str, labels: Labels = (),
+              collect: Optional[Collector] = None) -> Gauge:
+        metric = Gauge(name, help_, labels, collect)
+        self.register(metric)
+        return metric
+
+    def histogram(self, name: str, help_: str, labels: Labels = (),
+                  buckets: tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, help_, labels, buckets)
+        self.register(metric)
+        return metric
+
+    def render(self) -> str:
+        return ''.join(
+            metric.render() + '\n' for metric in self.metrics.values())
+
+
+METRICS = MetricsRegistry()
+COMMAND_DURATION = METRICS.histogram(
+    'nk_bot00_command_duration_seconds',
+    'Time spent handling commands', ('command',))
+COMMAND_ERRORS = METRICS.counter(
+    'nk_bot00_command_errors_total',
+    'Commands that failed, timed out or were rejected', ('command', 'reason'))
+LOOP_LAG = METRICS.histogram(
+    'nk_bot00_event_loop_lag_seconds',
+    'Delay of a scheduled wakeup on the event loop', buckets=LOOP_LAG_BUCKETS)
+CTF_POLL_DURATION = METRICS.histogram(
+    'nk_bot00_ctf_poll_duration_seconds',
+    'Time spent polling the CTF platform', ('phase',))
+CTF_POLL_TIMEOUTS = METRICS.counter(
+    'nk_bot00_ctf_poll_timeouts_total',
+    'CTF polls that timed out', ('phase',))
+HTTP_CLIENT_DURATION = METRICS.histogram(
+    'nk_bot00_http_client_duration_seconds',
+    'Time spent on outgoing HTTP requests', ('api', 'status'))
+HTTP_SERVER_DURATION = METRICS.histogram(
+    'nk_bot00_http_server_duration_seconds',
+    'Time spent handling HTTP requests', ('path', 'status'))
+
+
+async def monitor_loop_lag() -> None:
+    '''定期睡眠，实际醒来比预期晚的时间即事件循环被阻塞的时间'''
+    while True:
+        start = monotonic()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        LOOP_LAG.observe(max(0.0, monotonic() - start - LOOP_LAG_INTERVAL))
+
+
+def timed_endpoint(path: str, endpoint: Callable):
+    '''记录 ASGI 路由的处理时间'''
+    async def wrapper(request: Request):
+        start = perf_counter()
+        status = '500'
+        try:
+            response = await endpoint(request)
+            status = str(response.status_code)
+            return response
+        finally:
+            HTTP_SERVER_DURATION.observe(
+                perf_counter() - start, (path, status))
+    return wrapper
+
+
+async def on_http_metrics(_request: Request) -> PlainTextResponse:
+    '''GET /metrics
+
+    Prometheus 文本格式的指标'''
+    return PlainTextResponse(METRICS.render(), media_type=CONTENT_TYPE)
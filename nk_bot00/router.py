@@ -0,0 +1,151 @@
+import shlex
+from typing import Any, Awaitable, Callable, Optional
+
+from mirai import Mirai, FriendMessage, GroupMessage, MessageEvent
+
+from nk_bot00.exception import ArgumentException
+
+CommandHandler = Callable[[Mirai, MessageEvent, list[str], Any], Awaitable[None]]
+
+HELP_USAGE = (
+    '!h [命令]\n'
+    '  显示命令用法'
+)
+RELOAD_USAGE = (
+    '!reload\n'
+    '  重新加载配置'
+)
+SUPERUSER_COMMANDS = frozenset(('reload',))
+'''只有超级用户可以在私聊中使用的命令'''
+BUILTIN_COMMANDS = frozenset(('help',)) | SUPERUSER_COMMANDS
+'''不在 COMMAND_HANDLER 中、由 main 直接处理的命令'''
+SHLEX_CHARS = frozenset('\'"\\')
+'''包含这些字符时才需要 shlex 解析'''
+
+
+def render_usage(docstring: Optional[str]) -> str:
+    if docstring is None:
+        return HELP_USAGE
+    return '\n  '.join(s.strip() for s in docstring.splitlines(False))
+
+
+class CommandRouter:
+    '''启动时预先计算权限集合、别名与帮助文本，按消息找到命令与参数'''
+
+    def __init__(
+        self,
+        handlers: dict[str, CommandHandler],
+        alias: dict[str, str],
+        prefix: tuple[str, ...],
+        friend_permission: dict[int, list[str]],
+        group_permission: dict[int, list[str]],
+        superuser: Optional[int] = None
+    ) -> None:
+        self.handlers = handlers
+        self.alias = alias
+        self.prefix = prefix
+        if superuser is not None:
+            # 超级用户在私聊中总是可以使用 SUPERUSER_COMMANDS
+            friend_permission = {
+                **friend_permission,
+                superuser: (friend_permission.get(superuser, [])
+                            + sorted(SUPERUSER_COMMANDS))
+            }
+        self.friend_permission = {
+            k: frozenset(v) for k, v in friend_permission.items()}
+        '''{FriendId: {Command, ...}, ...}'''
+        self.group_permission = {
+            k: frozenset(v) for k, v in group_permission.items()}
+        '''{GroupId: {Command, ...}, ...}'''
+        self.usage = {
+            command: render_usage(handler.__doc__)
+            for command, handler in handlers.items()
+        }
+        '''{Command: Usage, ...}'''
+        self.usage['help'] = HELP_USAGE
+        self.usage['reload'] = RELOAD_USAGE
+        self.friend_help = {
+            k: self.render_help(v) for k, v in friend_permission.items()}
+        '''{FriendId: HelpMessage, ...}'''
+        self.group_help = {
+            k: self.render_help(v) for k, v in group_permission.items()}
+        '''{GroupId: HelpMessage, ...}'''
+
+    @staticmethod
+    def render_help(available_commands: list[str]) -> str:
+        return (
+            '![命令] [参数...]\n'
+            '  执行命令\n'
+            f'{HELP_USAGE}\n'
+            '  [命令] := ' + ' | '.join(available_commands)
+        )
+
+    def available_commands(self, event: MessageEvent) -> Optional[frozenset[str]]:
+        if isinstance(event, FriendMessage):
+            return self.friend_permission.get(event.sender.id)
+        if isinstance(event, GroupMessage):
+            return self.group_permission.get(event.group.id)
+        return None
+
+    def message(self, event: MessageEvent) -> Optional[str]:
+        '''返回以命令前缀开头的纯文本消息，其他消息尽早拒绝'''
+        components = event.message_chain.__root__
+        started = False
+        for component in components:
+            if component.type == 'Source':
+                continue
+            if component.type != 'Plain':
+                # 只接受纯文本
+                return None
+            if not started:
+                text = component.text.lstrip()
+                if text == '':
+                    continue
+                if not text.startswith(self.prefix):
+                    # 只接受允许的前缀开头的命令，不必拼接整条消息
+                    return None
+                started = True
+        if not started:
+            return None
+        return ''.join(
+            component.text for component in components
+            if component.type == 'Plain'
+        ).strip()
+
+    def route(self, event: MessageEvent) -> Optional[tuple[str, list[str]]]:
+        '''返回 (命令, 参数)，不是可用命令时返回 None'''
+        available_commands = self.available_commands(event)
+        if available_commands is None:
+            return None
+        message = self.message(event)
+        if message is None:
+            return None
+        message = message[1:].strip()
+        if SHLEX_CHARS.isdisjoint(message):
+            splitted = message.split()
+        else:
+            splitted = shlex.split(message)
+        if len(splitted) == 0:
+            # 不接受空命令
+            return None
+        command, *args = splitted
+        command = self.alias.get(command, command)
+        if command != 'help' and command not in available_commands:
+            return None
+        return command, args
+
+    def help_message(self, event: MessageEvent, args: list[str]) -> str:
+        if len(args) == 1:
+            command = args[0].strip()
+            if command.startswith(self.prefix):
+                # 只接受允许的前缀开头的命令
+                command = command[1:].strip()
+            command = self.alias.get(command, command)
+            if command in self.usage:
+                return self.usage[command]
+            raise ArgumentException('未知命令')
+        if len(args) > 1:
+            raise ArgumentException('参数过多')
+        if isinstance(event, FriendMessage):
+            return self.friend_help[event.sender.id]
+        return self.group_help[event.group.id]
@@ -0,0 +1,170 @@
+import asyncio
+from time import monotonic, perf_counter
+from typing import Any, Awaitable, Callable, Optional
+
+from nk_bot00.exception import ArgumentException, BusyException
+from nk_bot00.metrics import COMMAND_DURATION, COMMAND_ERRORS
+from nk_bot00.util import get_logger
+
+DEFAULT_CONCURRENCY = 4
+'''每个命令同时执行的最大数'''
+DEFAULT_TIMEOUT = 30.0
+'''命令执行的最长时间（秒）'''
+DEFAULT_SENDER_RATE = {'rate': 0.2, 'burst': 5}
+'''每个发送者每秒恢复 0.2 次，最多连续 5 次'''
+DEFAULT_GROUP_RATE = {'rate': 1.0, 'burst': 10}
+BUCKET_LIMIT = 4096
+'''超过此数量时清理已恢复满的令牌桶'''
+
+
+def is_positive(value: Any, integer: bool = False) -> bool:
+    if isinstance(value, bool):
+        return False
+    return isinstance(value, int if integer else (int, float)) and value > 0
+
+
+def validate_scheduler_config(config: Any) -> None:
+    '''检查 scheduler 配置，有错误时抛出 ValueError'''
+    if not isinstance(config, dict):
+        raise ValueError('scheduler is not an object')
+    for key, integer in (('concurrency', True), ('timeout', False)):
+        table = config.get(key, {})
+        if not isinstance(table, dict) or any(
+                not is_positive(v, integer) for v in table.values()):
+            raise ValueError(f'scheduler.{key} is not an object of positive '
+                             f'{"integers" if integer else "numbers"}')
+    for key, integer in (('default_concurrency', True),
+                         ('default_timeout', False)):
+        if key in config and not is_positive(config[key], integer):
+            raise ValueError(f'scheduler.{key} is not a positive '
+                             f'{"integer" if integer else "number"}')
+    for key in ('sender_rate', 'group_rate'):
+        rate = config.get(key, {'rate': 1, 'burst': 1})
+        if not isinstance(rate, dict) or any(
+                not is_positive(rate.get(k)) for k in ('rate', 'burst')):
+            raise ValueError(f'scheduler.{key} requires positive rate and burst')
+        # 每次命令消耗 1 个令牌，burst 小于 1 时永远无法执行
+        if rate['burst'] < 1:
+            raise ValueError(f'scheduler.{key}.burst is less than 1')
+
+
+class RateLimiter:
+    '''令牌桶，按键限制频率'''
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        '''每秒恢复的令牌数'''
+        self.burst = burst
+        self.buckets: dict[int, tuple[float, float]] = {}
+        '''{Key: (Token, Time), ...}'''
+        self.warned: set[int] = set()
+        '''已提示过频率限制的键，再次成功前不重复提示'''
+
+    def tokens(self, key: int, now: float) -> float:
+        if key not in self.buckets:
+            return self.burst
+        tokens, time = self.buckets[key]
+        return min(self.burst, tokens + (now - time) * self.rate)
+
+    def acquire(self, key: int) -> bool:
+        now = monotonic()
+        tokens = self.tokens(key, now)
+        if tokens < 1:
+            return False
+        self.buckets[key] = (tokens - 1, now)
+        self.warned.discard(key)
+        if len(self.buckets) > BUCKET_LIMIT:
+            self.buckets = {
+                k: v for k, v in self.buckets.items()
+                if self.tokens(k, now) < self.burst
+            }
+        return True
+
+    def warn(self, key: int) -> bool:
+        '''被限制后只提示一次，避免回复本身刷屏'''
+        if key in self.warned:
+            return False
+        self.warned.add(key)
+        return True
+
+
+class CommandScheduler:
+    '''在解析命令与执行命令之间限制并发、频率与执行时间
+
+    超出限制时立即拒绝而不是排队等待'''
+
+    def __init__(self, config: dict[str, Any]) -> None:
+        self.sender_limiter = RateLimiter(**DEFAULT_SENDER_RATE)
+        self.group_limiter = RateLimiter(**DEFAULT_GROUP_RATE)
+        self.in_flight: dict[str, int] = {}
+        '''{Command: InFlight, ...}'''
+        self.logger = get_logger('scheduler')
+        self.configure(config)
+
+    def configure(self, config: dict[str, Any]) -> None:
+        '''更新限制，保留正在执行的命令数与令牌桶'''
+        validate_scheduler_config(config)
+        self.concurrency: dict[str, int] = config.get('concurrency', {})
+        '''{Command: MaxInFlight, ...}'''
+        self.default_concurrency: int = config.get(
+            'default_concurrency', DEFAULT_CONCURRENCY)
+        self.timeout: dict[str, float] = config.get('timeout', {})
+        '''{Command: Second, ...}'''
+        self.default_timeout: float = config.get(
+            'default_timeout', DEFAULT_TIMEOUT)
+        for limiter, rate in (
+            (self.sender_limiter,
+             config.get('sender_rate', DEFAULT_SENDER_RATE)),
+            (self.group_limiter,
+             config.get('group_rate', DEFAULT_GROUP_RATE)),
+        ):
+            limiter.rate = rate['rate']
+            limiter.burst = rate['burst']
+
+    async def run(
+        self,
+        command: str,
+        sender: int,
+        group: Optional[int],
+        handler: Callable[[], Awaitable[None]]
+    ) -> Optional[str]:
+        '''执行命令，返回需要回复的拒绝或超时消息'''
+        if not self.sender_limiter.acquire(sender):
+            self.logger.info('Rate limited %s from %s', command, sender)
+            COMMAND_ERRORS.inc((command, 'rate_limited'))
+            return ('操作过于频繁，请稍后再试'
+                    if self.sender_limiter.warn(sender) else None)
+        if group is not None and not self.group_limiter.acquire(group):
+            self.logger.info('Rate limited %s in %s', command, group)
+            COMMAND_ERRORS.inc((command, 'rate_limited'))
+            return ('操作过于频繁，请稍后再试'
+                    if self.group_limiter.warn(group) else None)
+        in_flight = self.in_flight.get(command, 0)
+        if in_flight >= self.concurrency.get(command, self.default_concurrency):
+            self.logger.info('Rejected %s, %d in flight', command, in_flight)
+            COMMAND_ERRORS.inc((command, 'busy'))
+            return '繁忙，请稍后再试'
+        self.in_flight[command] = in_flight + 1
+        start = perf_counter()
+        try:
+            await asyncio.wait_for(
+                handler(), self.timeout.get(command, self.default_timeout))
+        except asyncio.TimeoutError:
+            self.logger.warning('Command %s from %s timed out', command, sender)
+            COMMAND_ERRORS.inc((command, 'timeout'))
+            return '执行超时'
+        except BusyException:
+            # 命令使用的线程池已满
+            self.logger.info('Rejected %s, executor is full', command)
+            COMMAND_ERRORS.inc((command, 'busy'))
+            return '繁忙，请稍后再试'
+        except ArgumentException:
+            COMMAND_ERRORS.inc((command, 'argument'))
+            raise
+        except Exception:
+            COMMAND_ERRORS.inc((command, 'exception'))
+            raise
+        finally:
+            self.in_flight[command] -= 1
+            COMMAND_DURATION.observe(perf_counter() - start, (command,))
+        return None
@@ -1,6 +1,10 @@
+import atexit
 import datetime
-import io
+import json
 import logging
+import logging.handlers
+import queue
+import threading
 from typing import Any, Callable, Optional, TextIO, Union
 
 from mirai.models.message import (
@@ -30,23 +34,173 @@ def forward_message(
     return Forward(node_list=nodes)
 
 
+LOG_FORMAT = '%(asctime)s - %(levelname)-8s %(message)s'
+LOG_DATEFMT = '%Y-%m-%d %H:%M:%S'
+LOG_QUEUE_SIZE = 10000
+'''等待写出的日志条数上限，超出时丢弃'''
+LOG_STOP_TIMEOUT = 5
+'''停止写出线程时等待的秒数，写出卡住时不再等待'''
+DEFAULT_LOGGING = {'level': 'DEBUG', 'json': False,
+                   'queue_size': LOG_QUEUE_SIZE}
+
+
+def parse_logging_config(config: dict[str, Any]) -> tuple[int, bool, int]:
+    '''返回 (级别, 是否输出 JSON, 队列长度)，有错误时抛出 ValueError'''
+    config = {**DEFAULT_LOGGING, **config}
+    level = logging.getLevelName(str(config['level']).upper())
+    if not isinstance(level, int):
+        raise ValueError(f'Unknown log level {config["level"]}')
+    if not isinstance(config['json'], bool):
+        raise ValueError('logging.json is not a boolean')
+    queue_size = config['queue_size']
+    if not isinstance(queue_size, int) or queue_size <= 0:
+        raise ValueError('logging.queue_size is not a positive integer')
+    return level, config['json'], queue_size
+
+
+class JsonFormatter(logging.Formatter):
+    '''每条日志输出为一行 JSON'''
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'time': self.formatTime(record, LOG_DATEFMT),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    '''队列已满时丢弃并计数，不阻塞事件循环'''
+
+    def __init__(self, queue_: queue.Queue) -> None:
+        super().__init__(queue_)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 只在调用线程中合并参数，格式化与异常回溯留给写出线程
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class DroppingQueueListener(logging.handlers.QueueListener):
+    '''停止时队列已满也不会失败，也不会无限等待卡住的写出线程'''
+
+    def __init__(self, handler: DroppingQueueHandler,
+                 *handlers: logging.Handler) -> None:
+        super().__init__(handler.queue, *handlers)
+        self.queue_handler = handler
+
+    def enqueue_sentinel(self) -> None:
+        try:
+            self.queue.put(self._sentinel, timeout=LOG_STOP_TIMEOUT)
+            return
+        except queue.Full:
+            pass
+        # 写出线程卡住，丢弃最早的日志给结束标记腾出位置
+        while True:
+            try:
+                self.queue.get_nowait()
+                self.queue_handler.dropped += 1
+            except queue.Empty:
+                pass
+            try:
+                self.queue.put_nowait(self._sentinel)
+                return
+            except queue.Full:
+                pass
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        self.enqueue_sentinel()
+        # 写出线程是守护线程，超时后不再等待，退出时也不会阻塞
+        self._thread.join(LOG_STOP_TIMEOUT)
+        self._thread = None
+
+
+class LogPipeline:
+    '''nk_bot00 的全部日志经过有界队列，由后台线程写出到 stderr'''
+
+    def __init__(self) -> None:
+        self.logger = logging.getLogger('nk_bot00')
+        self.stream_handler = logging.StreamHandler()
+        self.handler: Optional[DroppingQueueHandler] = None
+        self.listener: Optional[DroppingQueueListener] = None
+        self.queue_size = 0
+        self.configure({})
+        atexit.register(self.stop)
+
+    @property
+    def dropped(self) -> int:
+        return 0 if self.handler is None else self.handler.dropped
+
+    @property
+    def depth(self) -> int:
+        return 0 if self.handler is None else self.handler.queue.qsize()
+
+    def configure(self, config: dict[str, Any]) -> None:
+        '''按 config.json 中的 logging 更新级别与格式'''
+        level, json_, queue_size = parse_logging_config(config)
+        self.logger.setLevel(level)
+        if json_:
+            self.stream_handler.setFormatter(JsonFormatter())
+        else:
+            self.stream_handler.setFormatter(
+                logging.Formatter(LOG_FORMAT, datefmt=LOG_DATEFMT))
+        if queue_size != self.queue_size:
+            self.start(queue_size)
+
+    def start(self, queue_size: int) -> None:
+        '''换用新的队列，旧队列中的日志在后台写出后再停止旧线程'''
+        dropped = self.dropped
+        handler = DroppingQueueHandler(queue.Queue(queue_size))
+        handler.dropped = dropped
+        listener = DroppingQueueListener(handler, self.stream_handler)
+        listener.start()
+        self.logger.addHandler(handler)
+        if self.handler is not None:
+            self.logger.removeHandler(self.handler)
+        old = self.listener
+        self.handler, self.listener = handler, listener
+        self.queue_size = queue_size
+        if old is not None:
+            # 可能在事件循环中调用，不等待旧线程写完积压或卡住的日志
+            threading.Thread(
+                target=old.stop, name='nk_bot00-log-stop', daemon=True).start()
+
+    def stop(self) -> None:
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+
+LOG_PIPELINE: Optional[LogPipeline] = None
+
+
+def get_log_pipeline() -> LogPipeline:
+    global LOG_PIPELINE  # pylint: disable=global-statement
+    if LOG_PIPELINE is None:
+        LOG_PIPELINE = LogPipeline()
+    return LOG_PIPELINE
+
+
 def get_logger(name: Optional[str] = None) -> logging.Logger:
+    get_log_pipeline()
     if name is None:
-        logger_ = logging.getLogger('nk_bot00')
-    else:
-        logger_ = logging.getLogger('nk_bot00.' + name)
-    if logger_.hasHandlers():
-        return logger_
-    logger_.setLevel(logging.DEBUG)
-    ch = logging.StreamHandler()
-    ch.setLevel(logging.DEBUG)
-    formatter = logging.Formatter(
-        '%(asctime)s - %(levelname)-8s %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S'
-    )
-    ch.setFormatter(formatter)
-    logger_.addHandler(ch)
-    return logger_
+        return logging.getLogger('nk_bot00')
+    # 子 logger 不设置级别与 handler，传递给 nk_bot00 处理
+    return logging.getLogger('nk_bot00.' + name)
 
 
 def endswith_line_break(s: str) -> bool:
@@ -57,24 +211,26 @@ class LoggerWrapper:
     def __init__(self, log_func: Callable, origin: TextIO) -> None:
         self.log_func = log_func
         self.origin = origin
-        self._buffer = io.StringIO()
+        self._buffer: list[str] = []
+        '''尚未遇到换行的片段'''
 
     def write(self, s: str) -> int:
-        if s == '':
-            return 0
-        lines = s.splitlines(True)
-        if len(lines) > 1 or endswith_line_break(lines[0]):
-            lines[0] = self._buffer.getvalue() + lines[0]
-            self._buffer = io.StringIO()
-            for line in lines[:-1]:
-                self.log_func(line[:-1])  # remove tailing line break
-            if endswith_line_break(lines[-1]):
-                self.log_func(lines[-1][:-1])
-            else:
-                self._buffer.write(lines[-1])
-        else:
-            self._buffer.write(s)
-        return len(s)
+        length = len(s)
+        if '\n' not in s and '\r' not in s:
+            # 大多数 write 不含换行，只保存片段
+            if s != '':
+                self._buffer.append(s)
+            return length
+        if len(self._buffer) > 0:
+            self._buffer.append(s)
+            s = ''.join(self._buffer)
+            self._buffer.clear()
+        lines = s.splitlines()
+        if not endswith_line_break(s):
+            self._buffer.append(lines.pop())
+        for line in lines:
+            self.log_func(line)
+        return length
 
     def flush(self) -> None:
         pass